@@ -0,0 +1,11 @@
+import multiprocessing
+import os
+
+# runs have their own dirs so workers can be scaled to the cores
+bind = 'unix:/app/app.sock'
+# each worker has its own pool of LIPIDX_JOB_PROCESSES background job
+# processes, so workers * LIPIDX_JOB_PROCESSES jobs can run at once
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+timeout = 90
+loglevel = 'debug'
+errorlog = '-'
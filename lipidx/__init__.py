@@ -1,17 +1,14 @@
-from flask import Flask
-from flask_bootstrap import Bootstrap
-from lipidx.views import lipidx_bp
-from lipidx import config
-import logging
-import sys, os
-
-sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
-sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'lipid_analysis.log'))
-logging.basicConfig(level=logging.DEBUG)
-app = Flask(__name__)
-app.register_blueprint(lipidx_bp, url_prefix='/lipidx', static_folder='static')
-app.config.from_object(config)
-bootstrap = Bootstrap()
-bootstrap.init_app(app)
-
-import lipidx.views
+def __getattr__(name):
+    # the flask app is made in webapp on first use, so the analysis modules
+    # can be imported, e.g. by worker processes, without the app and its
+    # config
+    if name in ('app', 'bootstrap'):
+        try:
+            from lipidx import webapp
+        except AttributeError as e:
+            # e.g. a setting missing from the environment, an AttributeError
+            # here would be reported as the name not being in lipidx
+            raise ImportError('could not make the lipidx app: ' +
+                    str(e)) from e
+        return getattr(webapp, name)
+    raise AttributeError("module 'lipidx' has no attribute " + repr(name))
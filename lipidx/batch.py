@@ -0,0 +1,146 @@
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from lipidx.lipid_pipeline import LipidPipeline
+from lipidx.result_cache import ResultCache
+from lipidx.settings import AnalysisSettings
+from lipidx.stage_report import StageReport
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_FILE = 'summary.json'
+# manifest cols that are not analysis params
+FILE_COLS = ('name', 'file1', 'file2')
+
+
+def param_value(default, value):
+    # manifest cells are text, converted to the type of the form default
+    if isinstance(default, bool):
+        return value.strip().lower() in ('1', 'true', 'yes', 'y')
+    if isinstance(default, (int, float)):
+        return type(default)(value)
+    return value
+
+
+def read_manifest(path, params):
+    # one run per row: name, file1, file2 and any form params that differ
+    # from params, relative file paths are from the manifest's dir
+    base = os.path.dirname(os.path.abspath(path))
+    runs = []
+    with open(path, newline='') as f:
+        reader = csv.DictReader(f)
+        unknown = [c for c in reader.fieldnames if c not in FILE_COLS and c
+                not in params]
+        if unknown:
+            raise ValueError('Unknown manifest cols: ' + ', '.join(unknown))
+        for i, row in enumerate(reader):
+            files = [os.path.join(base, row[col]) for col in ('file1',
+                'file2') if row.get(col)]
+            if not files:
+                raise ValueError('No files in manifest row %d' % (i + 1))
+            name = row.get('name') or os.path.splitext(
+                    os.path.basename(files[0]))[0]
+            if os.sep in name or name.startswith('.'):
+                raise ValueError('Bad run name: ' + name)
+            run_params = dict(params)
+            for col, value in row.items():
+                if col not in FILE_COLS and value:
+                    run_params[col] = param_value(params[col], value)
+            runs.append({'name': name, 'files': files, 'params': run_params})
+    names = [run['name'] for run in runs]
+    dups = sorted(set(name for name in names if names.count(name) > 1))
+    if dups:
+        raise ValueError('Run names used more than once: ' + ', '.join(dups))
+    return runs
+
+
+def run_one(run, out_dir, chart_processes):
+    # the whole pipeline for one row of the manifest, in a worker, results
+    # go to a dir named after the run, a failed run doesn't stop the others
+    root_path = os.path.join(out_dir, run['name']) + '/'
+    if not os.path.exists(root_path):
+        os.makedirs(root_path)
+    report = StageReport()
+    result = {'name': run['name'], 'files': run['files'], 'dir': root_path,
+            'status': 'ok', 'error': None, 'rows': None}
+    start = time.perf_counter()
+    try:
+        # a cache of size 0 stores and finds nothing
+        cache = ResultCache(root_path + 'stages/', 0)
+        settings = AnalysisSettings(root_path,
+                chart_processes=chart_processes)
+        pipeline = LipidPipeline(cache, run['files'], '', run['params'],
+                root_path, report, settings)
+        la = pipeline.run()
+        la.zip_data[report.FILE] = report.to_json().encode()
+        report.run('export', lambda la: la.write_results(), la)
+        result['rows'] = len(la.table)
+        result['chart_errors'] = dict(la.chart_errors)
+    except Exception as e:
+        logger.exception('Run %s failed', run['name'])
+        result['status'] = 'failed'
+        result['error'] = repr(e)
+    result['wall_time'] = time.perf_counter() - start
+    result['stages'] = report.records
+    with open(root_path + StageReport.FILE, 'w') as f:
+        f.write(report.to_json())
+    return result
+
+
+def run_batch(runs, out_dir, processes, chart_processes=1):
+    # runs share the pool, results are in manifest order
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    start = time.perf_counter()
+    with ProcessPoolExecutor(processes) as executor:
+        results = list(executor.map(run_one, runs, [out_dir] * len(runs),
+            [chart_processes] * len(runs)))
+    summary = {'processes': processes,
+            'wall_time': time.perf_counter() - start, 'runs': results}
+    with open(os.path.join(out_dir, SUMMARY_FILE), 'w') as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+            description='Run the lipid analysis on every file pair of a '
+            'manifest csv with cols name, file1, file2 and any form params')
+    parser.add_argument('manifest')
+    parser.add_argument('out_dir')
+    parser.add_argument('--params',
+            help='json file of form params used for every run')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(),
+            help='runs at the same time')
+    parser.add_argument('--chart-processes', type=int, default=1,
+            help='chart workers of each run')
+    args = parser.parse_args(args)
+    params = LipidPipeline.default_params()
+    if args.params:
+        with open(args.params) as f:
+            extra = json.load(f)
+        unknown = [k for k in extra if k not in params]
+        if unknown:
+            parser.error('Unknown params: ' + ', '.join(unknown))
+        params.update(extra)
+    try:
+        runs = read_manifest(args.manifest, params)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    summary = run_batch(runs, args.out_dir, args.processes,
+            args.chart_processes)
+    for result in summary['runs']:
+        print('%-30s %-6s %8.2fs %s' % (result['name'], result['status'],
+            result['wall_time'], result['error'] or '%s rows' %
+            result['rows']))
+    print('%d runs in %.2fs' % (len(summary['runs']), summary['wall_time']))
+    return 1 if any(r['status'] != 'ok' for r in summary['runs']) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,146 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import tempfile
+import time
+import numpy
+from lipidx import synthetic_data
+from lipidx.lipid_pipeline import LipidPipeline
+from lipidx.result_cache import ResultCache
+from lipidx.settings import AnalysisSettings
+from lipidx.stage_report import StageReport
+
+SCALES = (1000, 10000, 100000)
+
+
+def benchmark_params(blank):
+    # form defaults, with normalizing, a volcano plot and the blank so every
+    # stage has work to do
+    params = LipidPipeline.default_params()
+    params.update({'blank': blank, 'normalize': 'intensity', 'group1': 's1',
+        'group2': 's2'})
+    return params
+
+
+def run_stages(paths, root_path, trace_memory, blank):
+    # one uncached run of all pipeline stages and the export
+    report = StageReport(trace_memory)
+    # a cache of size 0 stores and finds nothing
+    cache = ResultCache(root_path + 'stages/', 0)
+    pipeline = LipidPipeline(cache, paths, '', benchmark_params(blank),
+            root_path, report, AnalysisSettings(root_path))
+    la = pipeline.run()
+    report.run('export', lambda la: la.write_results(), la)
+    return report.records
+
+
+def summarize(runs, traced):
+    # median times of the untraced runs, peak memory of the traced one
+    summary = []
+    for i, record in enumerate(runs[0]):
+        walls = [run[i]['wall_time'] for run in runs]
+        cpus = [run[i]['cpu_time'] for run in runs]
+        summary.append({'stage': record['stage'],
+            'wall_time': statistics.median(walls),
+            'cpu_time': statistics.median(cpus),
+            'peak_memory': traced[i]['peak_memory'] if traced else None,
+            'rows_before': record['rows_before'],
+            'rows_after': record['rows_after'],
+            'cols_after': record['cols_after']})
+    return summary
+
+
+def benchmark(scales, repeat=3, memory=True, files=2, groups=None,
+        replicates=3, seed=0, data_dir=None):
+    # times each stage at each scale, the data is generated once per scale
+    groups = groups or synthetic_data.GROUPS
+    work_dir = tempfile.mkdtemp(prefix='lipidx_bench')
+    results = []
+    try:
+        for features in scales:
+            paths = []
+            for i, polarity in enumerate(('neg', 'pos')[:files]):
+                # named by everything that changes the data so kept
+                # files are only reused for the same settings
+                path = os.path.join(data_dir or work_dir,
+                        '%s_%d_%s_%d_%d.txt' % (polarity, features,
+                        '-'.join(groups), replicates, seed + i))
+                if not os.path.exists(path):
+                    synthetic_data.generate(path, features, groups,
+                            replicates, polarity, seed + i)
+                paths.append(path)
+            root_path = os.path.join(work_dir, 'run_%d' % features) + '/'
+            os.makedirs(root_path)
+            runs = [run_stages(paths, root_path, False, groups[0]) for i in
+                    range(repeat)]
+            traced = None
+            if memory:
+                traced = run_stages(paths, root_path, True, groups[0])
+            results.append({'features': features, 'files': files,
+                'groups': list(groups), 'replicates': replicates,
+                'bytes': sum(os.path.getsize(path) for path in paths),
+                'stages': summarize(runs, traced), 'runs': runs})
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return {'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(), 'numpy': numpy.__version__,
+        'platform': platform.platform(), 'cpus': os.cpu_count(),
+        'repeat': repeat, 'seed': seed}, 'results': results}
+
+
+def compare(old, new):
+    # lines of new/old median wall time per scale and stage
+    lines = []
+    old_stages = {(r['features'], s['stage']): s for r in old['results'] for
+            s in r['stages']}
+    for result in new['results']:
+        for stage in result['stages']:
+            before = old_stages.get((result['features'], stage['stage']))
+            if before is None or not before['wall_time']:
+                continue
+            lines.append('%9d %-15s %8.3fs -> %8.3fs  x%.2f' % (
+                result['features'], stage['stage'], before['wall_time'],
+                stage['wall_time'], stage['wall_time'] / before['wall_time']))
+    return lines
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+            description='Time each lipid analysis stage on synthetic data')
+    parser.add_argument('--scales', type=int, nargs='+', default=SCALES,
+            help='features per file, e.g. 1000 10000 100000 1000000')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--files', type=int, choices=(1, 2), default=2,
+            help='neg only or neg and pos')
+    parser.add_argument('--groups', default=','.join(synthetic_data.GROUPS))
+    parser.add_argument('--replicates', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-memory', action='store_true',
+            help='skip the traced run for peak memory')
+    parser.add_argument('--data-dir',
+            help='keep generated files here to reuse them')
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--compare', help='earlier output to compare with')
+    args = parser.parse_args(args)
+    if args.data_dir and not os.path.exists(args.data_dir):
+        os.makedirs(args.data_dir)
+    results = benchmark(args.scales, args.repeat, not args.no_memory,
+            args.files, args.groups.split(','), args.replicates, args.seed,
+            args.data_dir)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    for result in results['results']:
+        for stage in result['stages']:
+            print('%9d %-15s %8.3fs wall %8.3fs cpu' % (result['features'],
+                stage['stage'], stage['wall_time'], stage['cpu_time']))
+    if args.compare:
+        with open(args.compare) as f:
+            print('\n'.join(compare(json.load(f), results)))
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -11,6 +11,45 @@ if loglevel == 'DEBUG':
 WTF_CSRF_SECRET_KEY = os.environ.get('WTF_CSRF_KEY',"aEsu'a}-j\>rJ4'8MFz{<yn")
 UPLOAD_FOLDER = os.path.join(BASE_DIR, 'files/')
 FILE_FOLDER = os.path.join(BASE_DIR, 'files/')
+# files of FILE_FOLDER anyone can download, e.g. the example input files
+SHARED_FILES = frozenset(['pca_template.csv'])
+# state of the server, e.g. the background jobs, kept out of the dirs files
+# are served from as it names the runs of every user
+STATE_FOLDER = os.environ.get('LIPIDX_STATE_DIR', os.path.join(BASE_DIR, 'state/'))
 ALLOWED_EXTENSIONS = set(['txt', 'pdf', 'png', 'jpeg', 'gif', 'doc', 'xls', 'csv'])
 MAX_CONTENT_LENGTH = 100 * 1024 * 1024
+# worker processes used to draw the chart images for the results zip
+CHART_PROCESSES = int(os.environ.get('LIPIDX_CHART_PROCESSES', 2))
+# seconds to wait for a chart worker before its chart is left out of the
+# zip, 0 for no limit
+CHART_TIMEOUT = int(os.environ.get('LIPIDX_CHART_TIMEOUT', 300))
+# bokeh backend of the volcano plots on the page, webgl, canvas or svg
+VOLCANO_BACKEND = os.environ.get('LIPIDX_VOLCANO_BACKEND', 'webgl')
+# thin out points outside the highlight boxes above this many, 0 for all
+VOLCANO_MAX_POINTS = int(os.environ.get('LIPIDX_VOLCANO_MAX_POINTS', 0))
+# deflate level of the results zip, 0 (fastest) to 9 (smallest)
+ZIP_COMPRESS_LEVEL = int(os.environ.get('LIPIDX_ZIP_LEVEL', 6))
+# results of earlier runs kept under UPLOAD_FOLDER/cache, 0 to turn off
+RESULT_CACHE_SIZE = int(os.environ.get('LIPIDX_RESULT_CACHE_MB', 512)) * 1024 * 1024
+# outputs of the data stages kept under UPLOAD_FOLDER/stages, 0 to turn off
+STAGE_CACHE_SIZE = int(os.environ.get('LIPIDX_STAGE_CACHE_MB', 512)) * 1024 * 1024
+# results tables kept in binary form under UPLOAD_FOLDER/tables, so results
+# uploaded to the volcano and pca pages are not parsed again, 0 to turn off
+TABLE_STORE_SIZE = int(os.environ.get('LIPIDX_TABLE_STORE_MB', 512)) * 1024 * 1024
+# only build the zip and chart images when they are downloaded
+LAZY_RESULTS = os.environ.get('LIPIDX_LAZY_RESULTS', 'false').lower() == 'true'
+# run analyses in the background, the page polls the job until it is done
+BACKGROUND_JOBS = os.environ.get('LIPIDX_BACKGROUND_JOBS', 'false').lower() == 'true'
+# worker processes that run background jobs, jobs past this wait in a queue,
+# each gunicorn worker has its own, so up to this times workers jobs run
+JOB_PROCESSES = int(os.environ.get('LIPIDX_JOB_PROCESSES', 2))
+# background jobs not finished after this many minutes are marked failed, 0
+# for no limit, jobs of a stopped server process are failed right away
+JOB_TIMEOUT = int(os.environ.get('LIPIDX_JOB_TIMEOUT_MINUTES', 120)) * 60
+# dirs of runs under UPLOAD_FOLDER/runs are removed after this many hours, or
+# oldest first above this size, 0 to keep them
+RUN_MAX_AGE = int(os.environ.get('LIPIDX_RUN_MAX_HOURS', 24)) * 60 * 60
+RUN_MAX_SIZE = int(os.environ.get('LIPIDX_RUN_MAX_MB', 2048)) * 1024 * 1024
+# trace peak memory of each stage for the stage report, always on with ?debug
+TRACE_STAGE_MEMORY = os.environ.get('LIPIDX_TRACE_STAGE_MEMORY', 'false').lower() == 'true'
 SEND_FILE_MAX_AGE_DEFAULT = 0
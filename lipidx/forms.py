@@ -3,6 +3,7 @@ from wtforms import (IntegerField, FloatField, StringField,
     TextAreaField, RadioField, BooleanField)
 from wtforms.validators import Optional
 from flask_wtf.file import FileField, FileRequired
+from lipidx.settings import AnalysisSettings
 
 
 class ElseOptional(Optional):
@@ -23,8 +24,8 @@ class LipidAnalysisForm(FlaskForm):
     GROUP_AREA_DEFAULT = 0
     GROUP_HEIGHT_DEFAULT = 0
     MULT_FACTOR_DEFAULT = 3
-    RATIO_HIGHLIGHT_DEFAULT = 2.0
-    PVALUE_HIGHLIGHT_DEFAULT = 0.05
+    RATIO_HIGHLIGHT_DEFAULT = AnalysisSettings.RATIO_HIGHLIGHT
+    PVALUE_HIGHLIGHT_DEFAULT = AnalysisSettings.PVALUE_HIGHLIGHT
 
     COLS_TO_REMOVE = ['ARatio', 'HRatio', 'ADiff', 'HDiff', 'GroupHeight', 'HeightRSD',
         'Height', 'NormArea', 'NormHeight', 'Hwhm(L)', 'Hwhm(R)', 'AreaScore', 'DataId', 'Scan',
@@ -72,8 +73,8 @@ class LipidAnalysisForm(FlaskForm):
 
 class VolcanoForm(FlaskForm):
     #TODO: factor out the common form bits
-    RATIO_HIGHLIGHT_DEFAULT = 2.0
-    PVALUE_HIGHLIGHT_DEFAULT = 0.05
+    RATIO_HIGHLIGHT_DEFAULT = AnalysisSettings.RATIO_HIGHLIGHT
+    PVALUE_HIGHLIGHT_DEFAULT = AnalysisSettings.PVALUE_HIGHLIGHT
     file_msg = 'Must submit a file to process'
     file1 = FileField('File 1', [FileRequired()])
     group1 = StringField('group1')
@@ -0,0 +1,193 @@
+import json
+import logging
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from lipidx.lipid_pipeline import LipidPipeline
+from lipidx.stage_report import StageReport
+
+logger = logging.getLogger(__name__)
+
+# worker pool of this server process, made on the first submit
+_executors = {}
+
+
+class JobQueue:
+    # lipid analyses run in the background by a bounded pool of worker
+    # processes, the state of each job is kept in a sqlite file so any server
+    # process can show it, a job's files are in the dir of its run, the pool
+    # belongs to the server process the job was submitted to, so each
+    # gunicorn worker runs up to processes jobs at a time
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, db_path, processes):
+        self.db_path = db_path
+        self.processes = processes
+        with self.connect() as db:
+            db.execute('''CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY
+                KEY, status TEXT, params TEXT, context TEXT, error TEXT,
+                created REAL, started REAL, finished REAL)''')
+            # pid of the server process whose pool runs the job, added to
+            # dbs made before it
+            cols = [row['name'] for row in db.execute(
+                'PRAGMA table_info(jobs)')]
+            if 'owner' not in cols:
+                db.execute('ALTER TABLE jobs ADD COLUMN owner INTEGER')
+
+    @contextmanager
+    def connect(self):
+        # a connection per use, sqlite connections can't be shared by
+        # processes, the timeout waits for writes of other processes
+        db = sqlite3.connect(self.db_path, timeout=30)
+        db.row_factory = sqlite3.Row
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def executor(self):
+        # not a multiprocessing Pool, its workers are daemons and a job
+        # needs its own workers to read files and draw charts
+        executor = _executors.get(self.processes)
+        if executor is None:
+            # imported here so the app loads without multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            executor = ProcessPoolExecutor(self.processes)
+            _executors[self.processes] = executor
+        return executor
+
+    def submit(self, job_id, run_path, paths, params, cache, settings,
+            trace_memory=False, results=None, results_key=None):
+        # job_id is the id of the run whose dir is run_path, params are the
+        # form data, cache the stage cache of the pipeline, settings the
+        # AnalysisSettings so the worker doesn't need the flask app, the
+        # results are kept in the results cache under results_key if given
+        with self.connect() as db:
+            db.execute('INSERT INTO jobs (id, status, params, created, '
+                    'owner) VALUES (?, ?, ?, ?, ?)', (job_id, self.QUEUED,
+                    json.dumps(params, default=str), time.time(),
+                    os.getpid()))
+        try:
+            future = self.executor().submit(self.run, job_id, run_path,
+                    paths, params, cache, settings, trace_memory, results,
+                    results_key)
+        except Exception as e:
+            # e.g. a pool whose workers died, the next submit makes a new one
+            logger.exception('Could not submit job %s', job_id)
+            self.drop_executor()
+            self.fail(job_id, repr(e))
+            return job_id
+        future.add_done_callback(lambda f: self.check_future(job_id, f))
+        return job_id
+
+    def drop_executor(self):
+        executor = _executors.pop(self.processes, None)
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def check_future(self, job_id, future):
+        # run handles errors of the analysis, an error here is one of the
+        # pool, e.g. a worker that was killed, that run never got to record
+        if future.cancelled():
+            self.fail(job_id, 'cancelled')
+        elif future.exception() is not None:
+            logger.error('Job %s failed in the pool: %r', job_id,
+                    future.exception())
+            from concurrent.futures.process import BrokenProcessPool
+            if isinstance(future.exception(), BrokenProcessPool):
+                self.drop_executor()
+            self.fail(job_id, repr(future.exception()))
+
+    def fail(self, job_id, error):
+        # a job that is not finished is marked failed
+        with self.connect() as db:
+            db.execute('UPDATE jobs SET status = ?, error = ?, finished = ? '
+                    'WHERE id = ? AND status IN (?, ?)', (self.FAILED, error,
+                    time.time(), job_id, self.QUEUED, self.RUNNING))
+
+    def fail_stale(self, timeout):
+        # jobs that will never finish are marked failed, those queued or
+        # running longer than timeout seconds, 0 for no limit, and those of
+        # server processes that are gone, e.g. restarted gunicorn workers
+        with self.connect() as db:
+            rows = db.execute('SELECT id, created, owner FROM jobs WHERE '
+                    'status IN (?, ?)', (self.QUEUED, self.RUNNING)).fetchall()
+        now = time.time()
+        for row in rows:
+            if timeout and row['created'] < now - timeout:
+                self.fail(row['id'], 'timed out')
+            elif row['owner'] and not self.is_alive(row['owner']):
+                self.fail(row['id'], 'server process stopped')
+
+    @staticmethod
+    def is_alive(pid):
+        if pid == os.getpid():
+            return True
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            # another user's process
+            return True
+        return True
+
+    def get(self, job_id):
+        # the job as a dict with params and context decoded, None if unknown
+        with self.connect() as db:
+            row = db.execute('SELECT * FROM jobs WHERE id = ?',
+                    (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        for name in ('params', 'context'):
+            if job[name] is not None:
+                job[name] = json.loads(job[name])
+        return job
+
+    def update(self, job_id, **values):
+        cols = ', '.join(name + ' = ?' for name in values)
+        with self.connect() as db:
+            db.execute('UPDATE jobs SET ' + cols + ' WHERE id = ?',
+                    list(values.values()) + [job_id])
+
+    def remove_old(self, before):
+        # jobs created before a time, their run dirs are cleaned up by then
+        with self.connect() as db:
+            db.execute('DELETE FROM jobs WHERE created < ?', (before,))
+
+    def run(self, job_id, run_path, paths, params, cache, settings,
+            trace_memory=False, results=None, results_key=None):
+        # runs in a worker, jobs failed while they were queued are skipped
+        with self.connect() as db:
+            started = db.execute('UPDATE jobs SET status = ?, started = ? '
+                    'WHERE id = ? AND status = ?', (self.RUNNING, time.time(),
+                    job_id, self.QUEUED)).rowcount
+        if not started:
+            return
+        try:
+            report = StageReport(params.get('debug') or trace_memory)
+            pipeline = LipidPipeline(cache, paths, cache.file_key(paths),
+                    params, run_path, report, settings)
+            la = pipeline.run()
+            la.zip_data[report.FILE] = report.to_json().encode()
+            report.run('export', lambda la: la.write_results(), la)
+            context = dict(pipeline.context, chart_errors=la.chart_errors)
+            if params.get('debug'):
+                context['stage_report'] = report.records
+            if results_key:
+                # before the job is done, so the same files sent again once
+                # the page shows the results are a cache hit
+                results.put_results(results_key, la, context)
+        except Exception as e:
+            logger.exception('Job %s failed', job_id)
+            self.update(job_id, status=self.FAILED, error=repr(e),
+                    finished=time.time())
+            return
+        self.update(job_id, status=self.DONE, context=json.dumps(context),
+                finished=time.time())
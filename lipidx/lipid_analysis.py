@@ -1,43 +1,54 @@
 import csv
+import io
 import os
+import tempfile
 import numpy
 import re
 from math import pi
-from scipy.stats import ttest_ind
 import zipfile
-from flask import current_app as app
+import logging
+import pickle
 from collections import OrderedDict
-from lipidx.forms import LipidAnalysisForm
-from bokeh.layouts import gridplot
-from bokeh.plotting import figure
-from bokeh.models import (HoverTool, ColumnDataSource, Whisker, BoxAnnotation, Legend, FactorRange)
-from bokeh.embed import components
-from bokeh.palettes import d3
-from bokeh.io import export_svgs, export_png
-from multiprocessing import Pool
+from bisect import bisect_left, bisect_right
+from lipidx.lipid_table import LipidTable
+from lipidx.lipid_reader import LipidSearchReader
+from lipidx.settings import AnalysisSettings
+from lipidx.table_store import HashWriter, TableStore
+# bokeh, scipy, the chart images and worker pools are imported where they
+# are used, most processes, e.g. file views and pool workers, never need
+# them and they are slow to import
+
+logger = logging.getLogger(__name__)
 
 
 class LipidAnalysis:
     MAX_CLASSES = 20
-    ROUND_TO = 2
-    POST_NORMAL_ROUND = 8
     NEGATIVE_IONS_WITH_PLUS = ['HCOO', 'CH3COO', 'CL']
+    # lipid charge and adduct from a row name like PC(16:0/18:1)+HCOO_12.3
+    LIPID_CHARGE_RE = re.compile('(.*[+,-])(.*)_.*')
     # limited cols as a string because remove cols takes a string (for now)
     LIMITED_COLS = '''name, ret_time, lipidion, class, fattyacid, fa1, fa2, fa3,
         fa4, calcmz, ionformula, area, ratio, p_value'''
     MAX_VOLCANO_PLOTS = 3
-
-    def __init__(self, paths, debug=False):
+    CHART_ERRORS_FILE = 'chart_errors.txt'
+    # cells per axis of the grid used to thin dense volcano regions
+    VOLCANO_GRID = 50
+    ZIP_FILE = 'lipid_results.zip'
+    # results saved for lazy mode, the zip and charts are built from it
+    SNAPSHOT_FILE = 'lipid_results.pickle'
+
+    def __init__(self, paths, debug=False, root_path=None, settings=None):
         self.paths = paths
+        # an AnalysisSettings, those of the flask app in use if not given
+        self.set_settings(settings or AnalysisSettings.current())
         # debug adds cols to results to show pre normalized values
         self.debug = debug
-        self.area_start = 'area['
         self.group_area_start = 'grouparea['
         self.groups = {}
 
         # cols should be the same in all files
         # col names will be taken from first file
-        self.rows = self.get_rows_from_files(self.paths)
+        self.table = self.get_rows_from_files(self.paths)
         # several functions will need to know the group names
         self.groups = self.get_groups()
 
@@ -47,425 +58,527 @@ class LipidAnalysis:
         self.class_dict = {}
         self.subclass_dict = {}
 
-        # file paths, eventualy these may not be hardcoded
-        self.root_path = app.config['UPLOAD_FOLDER']
-        lipid_class_file = 'lipidKey.csv'
-        self.lipid_class_path = app.config['BASE_DIR'] + '/' + lipid_class_file
+        # file paths, results are written to the run's dir
         self.lipid_results_file = 'lipid_analysis.csv'
-        self.lipid_results_path = self.root_path + self.lipid_results_file
         self.lipid_results_limited_file = 'lipid_analysis_summary.csv'
-        self.lipid_results_limited_path = self.root_path + self.lipid_results_limited_file
-        self.paths_to_zip = {}
-        zip_file = 'lipid_results.zip'
-        self.zip_path = self.root_path + zip_file
+        # csvs written into the zip, zip name -> (cols, rows)
+        self.csvs_to_zip = OrderedDict()
+        # chart images are queued by the plot functions and drawn together
+        # in export_charts, zip file names -> (draw function, args)
+        self.charts = OrderedDict()
+        self.chart_images = OrderedDict()
+        # contents of other files to zip, zip name -> bytes
+        self.zip_data = OrderedDict()
+        self.chart_errors = OrderedDict()
+        self.zip_file = self.ZIP_FILE
+        self.set_root_path(root_path)
 
         # set lipid classes
         self.class_keys = self.load_lipid_classes()
 
+    def set_settings(self, settings):
+        # also used for cached results made with other settings, the chart,
+        # volcano and zip settings can be changed on the instance after
+        self.settings = settings
+        self.lipid_class_path = settings.lipid_key_path
+        self.chart_processes = settings.chart_processes
+        self.chart_timeout = settings.chart_timeout
+        self.volcano_backend = settings.volcano_backend
+        self.volcano_max_points = settings.volcano_max_points
+        self.zip_level = settings.zip_level
+        self.zip_spool_size = settings.zip_spool_size
+
+    def set_root_path(self, root_path=None):
+        # dir the result files are written to, e.g. when cached results are
+        # used for another run
+        self.root_path = root_path or self.settings.root_path
+        self.zip_path = self.root_path + self.zip_file
+        self.snapshot_path = self.root_path + self.SNAPSHOT_FILE
+
+    @property
+    def rows(self):
+        # dict rows are built from the table on demand, e.g. for writing csvs
+        return self.table.to_rows()
+
+    @rows.setter
+    def rows(self, rows):
+        self.table = LipidTable.from_rows(rows)
+        self.groups = self.get_groups()
+
     def get_rows_from_files(self, paths):
-        rows = OrderedDict()
-        cols = []  # cols common to all files
-        set_name = True
-        for path in paths:
-            if path:
-                with open(path, 'r') as f:
-                    for i, ln in enumerate(f):
-                        if i == 0:
-                            row_cols = []
-                        if (ln.startswith('#') or ln.startswith('\t') or
-                                ln.startswith('\n')):
-                            continue
-                        if not row_cols:
-                            ln = ln.replace('\n', '')
-                            file_cols = re.split('\t|,', ln)
-                            # Only add name and ret_time if not there
-                            # for volcano only it will already be there
-                            if 'name' in file_cols:
-                                set_name = False
-                                row_cols = file_cols
-                            else:
-                                row_cols = ['name', 'ret_time']  # these two columns added first
-                                row_cols.extend(file_cols)
-                        else:  # data lines
-                            ln = ln.replace('\n', '')
-                            file_row = re.split('\t|,', ln)
-                            if set_name:
-                                row = ['', '']  # filler vals for name and ret_time
-                                row.extend(file_row)
-                            else:
-                                row = file_row
-                            # remove trailing newline
-                            row[(len(row) - 1)] = row[(len(row) - 1)].strip('\n')
-                            # lowercase the cols before creating dictionary
-                            row_cols = [x.lower() for x in row_cols]
-                            row_d = OrderedDict(zip(row_cols, row))
-                            if set_name:  #  not necessary if volcano only
-                                # calc retention time: average of GroupTopPos
-                                ret_time = round(numpy.mean(self.list_col_type(row_d, 'grouptoppos')), self.ROUND_TO)
-                                row_d['ret_time'] = ret_time  # add to row
-                                # unique name for row LipidIon + ret_time
-                                name = row_d['lipidion'] + '_' + str(ret_time)
-                                row_d['name'] = name
-                            else:
-                                name = row_d['name']
-                            if name in rows:  # rare case
-                                # if lipid has same name then keep the one with
-                                # greater area
-                                avg_areas = self.list_col_type(row_d, self.area_start)
-                                avg_prev_areas = self.list_col_type(rows[name], self.area_start)
-                                if avg_areas > avg_prev_areas:
-                                    rows[name] = row_d
-                            else:  # add the new row
-                                rows[name] = row_d
-
-                # ensure cols are the same for all rows
-                if not cols:  # set cols to first file
-                    cols = row_cols
-                else:  # after second file ensure cols in each row are the same
-                    cols = set(cols).intersection(row_cols)
-                    for key, row in rows.items():
-                        rows[key] = self.limit_row_cols(cols, row)
-        return rows
-
-    def limit_row_cols(self, cols, row):
-        if cols:
-            extra = set(row.keys()) - set(cols)
-            for k in extra:
-                del row[k]
-        return row
-
-    def get_cols(self, start=None):
-        first = list(self.rows.keys())[0]
-        keys = list(self.rows[first].keys())
-        if start:
-            keys = [i for i in keys if i.startswith(start)]
-        return keys
-
-    def write_results(self):
+        paths = [path for path in paths if path]
+        if not paths:
+            return LipidTable.empty()
+        # only cols common to all files are kept, in the order of the first,
+        # found from the headers so no file is parsed for cols that are dropped
+        headers = [LipidSearchReader(path).header() for path in paths]
+        cols = headers[0]
+        for header in headers[1:]:
+            common = set(header)
+            cols = [c for c in cols if c in common]
+        # results this app wrote are loaded from the table store, the other
+        # files are parsed
+        store = self.settings.table_store()
+        tables = [store.get(path) if store else None for path in paths]
+        args = [(path, cols, self.settings.round_to) for path, table in
+                zip(paths, tables) if table is None]
+        if len(args) > 1:
+            # the other files are parsed in workers while this process reads
+            # the first, e.g. pos while neg is read
+            from multiprocessing import Pool
+            pool = Pool(min(len(args) - 1, self.settings.read_processes))
+            try:
+                results = pool.starmap_async(self.read_file, args[1:])
+                parsed = [self.read_file(*args[0])]
+                parsed.extend(results.get())
+            finally:
+                # workers are stopped when a file can't be read too, so none
+                # are left behind in the server or job process
+                pool.terminate()
+                pool.join()
+        else:
+            parsed = [self.read_file(*a) for a in args]
+        parsed.reverse()
+        tables = [table if table is not None else parsed.pop() for table in
+                tables]
+        if len(tables) == 1 and tables[0].cols == cols:
+            # nothing to stack or drop, a stored table stays memory mapped
+            table = tables[0]
+        else:
+            table = LipidTable.concat(tables, cols)
+        return self.remove_duplicates(table)
+
+    @classmethod
+    def read_file(cls, path, cols=None,
+            round_to=AnalysisSettings.ROUND_TO):
+        reader = LipidSearchReader(path)
+        keep = None
+        if cols is not None:
+            # ret_time and name are computed from the file's own cols
+            keep = set(cols)
+            keep.update(c for c in reader.header() if c == 'lipidion' or
+                    c.startswith('grouptoppos['))
+        table = reader.read(keep)
+        if reader.set_name:  # not necessary if volcano only
+            # calc retention time: average of GroupTopPos
+            top_pos = table.prefix_values('grouptoppos')
+            ret_time = numpy.round(numpy.mean(top_pos, axis=1), round_to)
+            table.set_column('ret_time', ret_time)
+            # unique name for row LipidIon + ret_time
+            names = [ion + '_' + str(rt) for ion, rt in
+                    zip(table.column('lipidion'), ret_time.tolist())]
+            table.set_text_column('name', names)
+        table.names = table.column('name').copy()
+        return table
+
+    def remove_duplicates(self, table):
+        # if lipid has same name then keep the one with greater area, the
+        # kept row stays in the position of the first one seen (rare case)
+        slots = {}
+        keep = []
+        areas = None
+        for i, name in enumerate(table.names):
+            if name not in slots:
+                slots[name] = len(keep)
+                keep.append(i)
+            else:
+                if areas is None:
+                    areas = table.prefix_values('area')
+                prev = keep[slots[name]]
+                if areas[i].tolist() > areas[prev].tolist():
+                    keep[slots[name]] = i
+        if len(keep) < len(table):
+            table.select(keep)
+        return table
+
+    def get_cols(self, prefix=None):
+        # cols for a prefix (the part before the [) come from the schema
+        if prefix:
+            return list(self.table.schema.cols(prefix))
+        return list(self.table.cols)
+
+    def add_chart(self, files, draw, args):
+        # files are the zip names of the images one figure is saved to
+        self.charts[tuple(files)] = (draw, args)
+
+    def export_charts(self, only=None):
+        # draw queued chart images, in worker processes if configured, only
+        # limits it to the charts saved to those zip names
+        jobs = [(files, job) for files, job in self.charts.items() if only is
+                None or set(files) & set(only)]
+        for files, job in jobs:
+            del self.charts[files]
+        processes = min(self.chart_processes, len(jobs))
+        pool = None
+        if processes > 1:
+            from multiprocessing import Pool, TimeoutError
+            pool = Pool(processes)
+            results = [pool.apply_async(draw, (self.chart_formats(files),) +
+                args) for files, (draw, args) in jobs]
+            pool.close()
+        try:
+            for i, (files, (draw, args)) in enumerate(jobs):
+                try:
+                    if pool:
+                        # a worker that was killed never returns its chart
+                        images = results[i].get(self.chart_timeout or None)
+                    else:
+                        images = draw(self.chart_formats(files), *args)
+                except Exception as e:
+                    # a failed chart is left out of the zip, the rest still
+                    # goes in
+                    if pool and isinstance(e, TimeoutError):
+                        e = TimeoutError('no chart after %ss' %
+                                self.chart_timeout)
+                    logger.exception('Could not draw %s', ', '.join(files))
+                    for f in files:
+                        self.chart_errors[f] = repr(e)
+                    continue
+                # image bytes are kept in memory until they are zipped
+                for f, image in zip(files, images):
+                    self.chart_images[f] = image
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+        return self.chart_errors
+
+    def chart_formats(self, files):
+        return [os.path.splitext(f)[1][1:] for f in files]
+
+    def save_snapshot(self):
+        # lazy mode: keep the results to build the zip and charts only when
+        # they are downloaded, a zip from an earlier run is removed so it is
+        # not served for this one
+        if os.path.exists(self.zip_path):
+            os.remove(self.zip_path)
+        with open(self.snapshot_path, 'wb') as f:
+            pickle.dump(self, f)
+        return self.snapshot_path
+
+    @classmethod
+    def load_snapshot(cls, path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    def write_artifact(self, filename):
+        # build one downloadable file from a snapshot as a file object, None
+        # if it is not one of the files of these results
+        if filename == self.zip_file:
+            out = tempfile.SpooledTemporaryFile(max_size=self.zip_spool_size)
+            self.write_results(out)
+            out.seek(0)
+            return out
+        if any(filename in files for files in self.charts):
+            self.export_charts([filename])
+        if filename in self.chart_images:
+            return io.BytesIO(self.chart_images[filename])
+        return None
+
+    def write_results(self, out=None):
+        # the zip is written to out, a file object, or to zip_path, csvs and
+        # charts are streamed into it without intermediate files
+        self.export_charts()
         # get a list of results sorted by key
-        res = [x for y, x in sorted(self.rows.items(), key=lambda t: t[0].lower())]
-        # get cols from first row
-        cols = list(res[0].keys())
-        self.write_csv(self.lipid_results_path, cols, res)
-        # save results with limited cols
-        self.remove_columns(self.LIMITED_COLS, whitelist=True)
-        res = [x for y, x in sorted(self.rows.items(), key=lambda t: t[0].lower())]
-        cols = list(res[0].keys())
-        self.write_csv(self.lipid_results_limited_path, cols, res)
-        # create a zip file for lipids and stats
-        z = zipfile.ZipFile(self.zip_path, "w")
-        z.write(self.lipid_results_path, self.lipid_results_file)
-        z.write(self.lipid_results_limited_path, self.lipid_results_limited_file)
-        # save any other files (volcano, class_summary)
-        for filename, path in self.paths_to_zip.items():
-            if os.path.exists(path):
-                z.write(path, filename)
-        z.close
+        order = sorted(range(len(self.table)),
+                key=lambda i: self.table.names[i].lower())
+        z = zipfile.ZipFile(out or self.zip_path, 'w', zipfile.ZIP_DEFLATED,
+                compresslevel=self.zip_level)
+        with z:
+            digest = TableStore.new_digest()
+            if self.write_csv_entry(z, self.lipid_results_file,
+                    self.get_cols(), self.table.iter_rows(order), digest):
+                self.store_table(digest.hexdigest(), order,
+                        z.getinfo(self.lipid_results_file).file_size)
+            # save results with limited cols
+            self.remove_columns(self.LIMITED_COLS, whitelist=True)
+            self.write_csv_entry(z, self.lipid_results_limited_file,
+                    self.get_cols(), self.table.iter_rows(order))
+            # save any other csvs (class_summary)
+            for filename, (cols, rows) in self.csvs_to_zip.items():
+                self.write_csv_entry(z, filename, cols, rows)
+            for filename, data in self.zip_data.items():
+                z.writestr(filename, data)
+            # chart images (volcano, class charts)
+            for filename, image in self.chart_images.items():
+                z.writestr(filename, image)
+            if self.chart_errors:
+                z.writestr(self.CHART_ERRORS_FILE, ''.join(f + ': ' + e + '\n'
+                    for f, e in self.chart_errors.items()))
         return self.zip_path
 
-    def write_csv(self, path, cols, rows):
-        success = False
-        if self.rows:
-            if not os.path.exists(self.root_path):
-                os.makedirs(self.root_path)
-            with open(path, 'w') as c:
-                w = csv.DictWriter(c, cols)
-                w.writeheader()
-                w.writerows(rows)
-                success = True
-        return success
+    def write_csv_entry(self, z, filename, cols, rows, digest=None):
+        # rows are written one at a time into the compressed zip entry, and
+        # added to digest, a hashlib hash, if given
+        if not len(self.table):
+            return False
+        with z.open(filename, 'w') as entry:
+            if digest is not None:
+                entry = HashWriter(entry, digest)
+            c = io.TextIOWrapper(entry, newline='')
+            w = csv.DictWriter(c, cols)
+            w.writeheader()
+            w.writerows(rows)
+            c.flush()
+            c.detach()
+        return True
+
+    def store_table(self, key, order, size):
+        # the table of the results csv with key and size, for when it is
+        # uploaded to the volcano or pca page
+        store = self.settings.table_store()
+        if store is None:
+            return None
+        try:
+            return store.put(key, self.table, order, size)
+        except OSError:
+            logger.exception('Could not store the results table')
+            return None
 
     def subtract_blank(self, blank, mult_factor):
-        if blank and self.rows:
-            subtracted = {}
-            area_cols = self.get_cols(self.area_start)
-            blank_start = self.area_start + blank
-            blank_cols = self.get_cols(blank_start)
-            for name, row in self.rows.items():
-                # calculate avg blank
-                avg_blank = self.calculate_avg_blank(blank_cols, row)
-                include_row = False
-                # subtract blank * mult_factor from all area cols
-                for col in area_cols:
-                    sub = round((float(row[col]) - (avg_blank * mult_factor)),
-                            self.ROUND_TO)
-                    # negative areas are not permited, neg becomes 0
-                    if sub < 0:
-                        sub = 0
-                    row[col] = sub
-                    # only include row if atleast one non blank area is non-zero
-                    if sub > 0 and col not in blank_cols:
-                        include_row = True
-                if include_row:
-                    row['avg_blank'] = avg_blank
-                    subtracted[name] = row
-                    for col in blank_cols:
-                        del(row[col])
-            self.rows = subtracted
+        if blank and len(self.table):
+            area_cols = self.get_cols('area')
+            blank_cols = list(self.table.schema.group_cols.get(blank, []))
+            round_to = self.settings.round_to
+            # calculate avg blank for every row, rounded before it is used
+            # like the areas, so later stats are from the rounded areas
+            avg_blank = numpy.round(numpy.mean(self.table.group_values(blank),
+                axis=1), round_to)
+            # subtract blank * mult_factor from all area cols
+            areas = self.table.prefix_values('area')
+            areas -= (avg_blank * mult_factor)[:, numpy.newaxis]
+            numpy.round(areas, round_to, out=areas)
+            # negative areas are not permited, neg becomes 0
+            numpy.maximum(areas, 0, out=areas)
+            # only include row if atleast one non blank area is non-zero
+            is_blank = numpy.isin(area_cols, blank_cols)
+            include = (areas[:, ~is_blank] > 0).any(axis=1)
+            self.table.set_values(area_cols, areas)
+            self.table.set_column('avg_blank', avg_blank)
+            self.table.set_round(area_cols + ['avg_blank'], round_to)
+            self.table.select(include)
+            self.table.drop_columns(blank_cols)
             self.groups = self.get_groups()
-            self.rows = self.recalc_avg(self.rows)
-
-    def calculate_avg_blank(self, blank_cols, row):
-            blank_vals = []
-            for col in blank_cols:
-                if col in row:
-                    blank_vals.append(float(row[col]))
-            return round(numpy.mean(blank_vals), self.ROUND_TO)
+            self.recalc_avg()
 
     def remove_columns(self, remove_cols, whitelist=False):
-        if self.rows:
+        if len(self.table):
             # ensure user entered cols are lowercase and without spaces
             remove_cols = [x.strip().lower() for x in remove_cols.split(',')]
-            clean_selected = {}
             removed_cols = []
-            for col in self.get_cols():
-                prefix = col.split('[')[0]
+            for prefix, cols in self.table.schema.prefixes.items():
                 # remove cols contains the start of the column name before [
                 if prefix.lower() in remove_cols:
-                    removed_cols.append(col)
-            for name, row in self.rows.items():
-                new_row = OrderedDict()
-                if whitelist:  # include only cols from input
-                    for col, val in row.items():
-                        if col in removed_cols:
-                            new_row[col] = val
-                else:  # remove cols from input
-                    for col, val in row.items():
-                        if col not in removed_cols:
-                            new_row[col] = val
-                clean_selected[name] = new_row
-            self.rows = clean_selected
-
-    def list_col_type(self, row, col_type):
-        # get a list of all cols that startwith col_type
-        lst = []
-        for name, val in row.items():
-            if name.startswith(col_type):
-                lst.append(float(val))
-        return lst
+                    removed_cols.extend(cols)
+            if whitelist:  # include only cols from input
+                self.table.keep_columns(removed_cols)
+            else:  # remove cols from input
+                self.table.drop_columns(removed_cols)
 
     def group_ions(self, within):
         # for lipid charges with different ions but ret time within 0.9 only the
         # lipid ion with the greatest area will be kept
-        lc_grps = {}
-        ion_dups = {}
-        # group rows by lipid charge and ret time
-        for name, row in self.rows.items():
-            # capture lipid_charge
-            grps = re.search('(.*[+,-])(.*)_.*', name)
-            lipid_charge = grps.group(1)
-            adduct = grps.group(2)
-            # some negative ions actually start with a +, change those to - for
-            # the purpose of grouping
-            if adduct in self.NEGATIVE_IONS_WITH_PLUS:
-                lipid_charge = lipid_charge.replace(')+', ')-')
-            ret_time = row['ret_time']
-            if lipid_charge not in lc_grps:
-                # for ret_time store a list of lipid rows that are within 0.9
-                lc_grps[lipid_charge] = {ret_time: [name]}
+        ret_times = self.table.column('ret_time').tolist()
+        partitions = OrderedDict()
+        # group rows by lipid charge, rows keep their file order
+        for i, name in enumerate(self.table.names):
+            partitions.setdefault(self.lipid_charge(name), []).append(i)
+        # mean area of every row, computed once for all buckets
+        avg_areas = numpy.mean(self.table.prefix_values('area'), axis=1)
+        keep_rows = numpy.ones(len(self.table), dtype=bool)
+        for rows in partitions.values():
+            for bucket in self.ret_time_buckets(rows, ret_times, within):
+                if len(bucket) < 2:
+                    continue
+                # keep only the dup with the largest area, if no area is
+                # above 0 none of them are kept
+                areas = avg_areas[bucket]
+                valid = areas > 0
+                keep_rows[bucket] = False
+                if valid.any():
+                    best = numpy.argmax(numpy.where(valid, areas, -numpy.inf))
+                    keep_rows[bucket[best]] = True
+        self.table.select(keep_rows)
+
+    def lipid_charge(self, name):
+        # capture lipid_charge
+        grps = self.LIPID_CHARGE_RE.search(name)
+        lipid_charge = grps.group(1)
+        adduct = grps.group(2)
+        # some negative ions actually start with a +, change those to - for
+        # the purpose of grouping
+        if adduct in self.NEGATIVE_IONS_WITH_PLUS:
+            lipid_charge = lipid_charge.replace(')+', ')-')
+        return lipid_charge
+
+    def ret_time_buckets(self, rows, ret_times, within):
+        # each bucket is keyed on the ret time of the row that started it, a
+        # row joins the closest bucket within range or starts a new one.
+        # bucket ret times are kept sorted so the ones in range are found with
+        # a binary search instead of comparing against every bucket
+        starts = []  # sorted bucket ret times
+        order = []  # bucket number for each entry in starts
+        buckets = []
+        # search a little wider than within so float rounding in the bounds
+        # can't drop a bucket, the exact check is done below
+        reach = abs(within) * (1 + 1e-9) + 1e-9
+        for i in rows:
+            ret_time = ret_times[i]
+            lo = bisect_left(starts, ret_time - reach)
+            hi = bisect_right(starts, ret_time + reach)
+            # visit candidates in the order the buckets were started
+            found = None
+            min_diff = None
+            for b in sorted(order[lo:hi]):
+                diff = abs(ret_time - buckets[b][0])
+                if diff < within:
+                    if not min_diff or min_diff > diff:
+                        min_diff = diff
+                        found = b
+            if found is not None:
+                # add to closest bucket
+                buckets[found][1].append(i)
             else:
-                found = False
-                # see if curr ret time is within 0.9 of any others in this group
-                # if so choose the closest
-                min_diff = None
-                min_prev_ret = None
-                for prev_ret in lc_grps[lipid_charge]:
-                    diff = abs(float(ret_time) - float(prev_ret))
-                    if diff < within:
-                        if not min_diff or min_diff > diff:
-                            min_diff = diff
-                            min_prev_ret = prev_ret
-                            found = True
-                if found:
-                    # add to closest prev_ret group
-                    lc_grps[lipid_charge][min_prev_ret].append(name)
-                    # keep list of charges and ret times that have dups, for
-                    # faster filtering
-                    if lipid_charge not in ion_dups:
-                        ion_dups[lipid_charge] = []
-                    if min_prev_ret not in ion_dups[lipid_charge]:
-                        ion_dups[lipid_charge].append(min_prev_ret)
-                else:
-                    # start new ret_time bucket
-                    lc_grps[lipid_charge][ret_time] = [name]
-
-        for lc, r_times in ion_dups.items():
-            # loop through dups and keep only the one with largest area
-            for r in r_times:
-                max_area = 0
-                keep = None
-                for k in lc_grps[lc][r]:
-                    areas = self.list_col_type(self.rows[k], self.area_start)
-                    avg_area = numpy.mean(areas)
-                    if avg_area > max_area:
-                        max_area = avg_area
-                        keep = k
-                for j in lc_grps[lc][r]:
-                    # delete non-max areas of dup ions
-                    if j != keep:
-                        del(self.rows[j])
+                # start new ret_time bucket
+                pos = bisect_left(starts, ret_time)
+                starts.insert(pos, ret_time)
+                order.insert(pos, len(buckets))
+                buckets.append((ret_time, [i]))
+        return [members for start, members in buckets]
 
     def remove_rejects(self):
         # rejects must be removed before grouping ions
-        selected = {}
-        for name, row in self.rows.items():
-            if row['rej.'] == '0':
-                selected[name] = row
-        self.rows = selected
+        self.table.select(self.table.column('rej.') == '0')
 
     def filter_rows(self, ret_time_fil, group_pq_fil, group_sn_fil, group_area_fil,
             group_height_fil):
-        selected = {}
-        for name, row in self.rows.items():
-            # select only rows that pass all filters
-            if self.filter_in(row, ret_time_fil, group_pq_fil, group_sn_fil,
-                    group_area_fil, group_height_fil):
-                selected[name] = row
-        self.rows = selected
-
-    def filter_in(self, row, ret_time_fil, group_pq_fil, group_sn_fil,
+        # select only rows that pass all filters, in a single compaction
+        self.table.select(self.filter_mask(ret_time_fil, group_pq_fil,
+                group_sn_fil, group_area_fil, group_height_fil))
+
+    def filter_mask(self, ret_time_fil, group_pq_fil, group_sn_fil,
             group_area_fil, group_height_fil):
-        if float(row['ret_time']) <= ret_time_fil:
-            return False
-        group_pq_max = max(self.list_col_type(row, 'grouppq'))
-        if group_pq_max <= group_pq_fil:
-            return False
-        group_sn_max = max(self.list_col_type(row, 'groups/n'))
-        if group_sn_max <= group_sn_fil:
-            return False
+        keep = self.table.column('ret_time') > ret_time_fil
+        keep &= self.row_max('grouppq') > group_pq_fil
+        keep &= self.row_max('groups/n') > group_sn_fil
         if group_area_fil > 0:  # all values are pos ints, so skip if 0
-            group_area_max = max(self.list_col_type(row, 'grouparea'))
-            if group_area_max <= group_area_fil:
-                return False
+            keep &= self.row_max('grouparea') > group_area_fil
         if group_height_fil > 0:  # all values are pos ints, so skip if 0
-            group_height_max = max(self.list_col_type(row, 'groupheight'))
-            if group_height_max <= group_height_fil:
-                return False
-        return True
+            keep &= self.row_max('groupheight') > group_height_fil
+        return keep
+
+    def row_max(self, prefix):
+        # max of each row across the cols with prefix, NaN cells are skipped
+        return numpy.fmax.reduce(self.table.prefix_values(prefix), axis=1)
 
     def normalize(self, form_data):
         # most common is to not normalize
         # or one can use avg intensity calculated from data
         # or input manual values
-        if self.rows:
-            normal = self.rows
+        if len(self.table):
             # TODO: comma to seperate sample values in input S1-1 S1-2 etc
             if form_data['normalize'] != 'none':
-                area_cols = self.get_cols(self.area_start)
+                area_cols = self.get_cols('area')
+                # one factor per area col, cols with a nan factor are skipped
+                factors = numpy.full(len(area_cols), numpy.nan)
                 # use manual values
                 if form_data['normalize'] == 'values':
-                    for name, row in normal.items():
-                        for col in area_cols:
-                            group, num = self.get_group_from_col(col)
-                            form_name = 'normal_' + group
-                            # TODO: what if they don't fill it out
-                            if form_data[form_name]:
-                                # form field is comma separated values for each
-                                # numeric sample
-                                val = form_data[form_name].split(',')
-                                num = int(num)
-                                if num < len(val):
-                                    val = val[num].strip()
-                                    normal[name][col] = round(float(row[col]) / float(val), self.POST_NORMAL_ROUND)
+                    factors = self.normal_values(form_data, area_cols)
                 # use calculated intensity
                 elif form_data['normalize'] == 'intensity':
-                    intensities = self.calc_intensities(area_cols)
-                    for name, row in normal.items():
-                        for col in area_cols:
-                            sam = self.get_sample_from_col(col)
-                            if intensities[sam] > 0:
-                                normal[name][col] = round(float(row[col]) / intensities[sam],
-                                self.POST_NORMAL_ROUND)
-                normal = self.recalc_avg(normal)
-            self.rows = normal
-
-    def calc_intensities(self, area_cols):
-        # calc average from area_cols (intensity)
-        intensities = {}
-        for name, row in self.rows.items():
-            for col in area_cols:
-                sam = self.get_sample_from_col(col)
-                if sam not in intensities:
-                    intensities[sam] = []
-                intensities[sam].append(float(row[col]))
-        for sam, sum_lst in intensities.items():
-            intensities[sam] = round(numpy.mean(intensities[sam]), self.POST_NORMAL_ROUND)
-        return intensities
+                    factors = self.calc_intensities()
+                    factors[~(factors > 0)] = numpy.nan
+                scaled = ~numpy.isnan(factors) & (factors != 0)
+                areas = self.table.prefix_values('area')
+                areas[:, scaled] /= factors[scaled]
+                self.table.set_values(area_cols, areas)
+                self.table.set_round([col for col, s in zip(area_cols, scaled)
+                    if s], self.settings.post_normal_round)
+                self.recalc_avg()
+
+    def normal_values(self, form_data, area_cols):
+        # form field is comma separated values for each numeric sample, each
+        # group's field is only parsed once
+        fields = {}
+        factors = numpy.full(len(area_cols), numpy.nan)
+        for j, col in enumerate(area_cols):
+            group, num = self.table.schema.col_groups[col]
+            if group not in fields:
+                # TODO: what if they don't fill it out
+                field = form_data.get('normal_' + group)
+                fields[group] = field.split(',') if field else []
+            num = int(num)
+            if num < len(fields[group]):
+                factors[j] = float(fields[group][num].strip())
+        return factors
+
+    def calc_intensities(self):
+        # calc average of each area col (intensity)
+        return numpy.mean(self.table.prefix_values('area'), axis=0)
 
     def get_groups(self):
-        groups = OrderedDict()
-        area_cols = self.get_cols(self.area_start)
-        for a_col in area_cols:
-            group, num = self.get_group_from_col(a_col)
-            if group not in groups:
-                groups[group] = []
-            groups[group].append(num)
-        return groups
-
-    def get_group_from_col(self, col):
-        gr = col.split('[')[1]
-        gr = gr.split('-')
-        num = gr[1].split(']')[0]
-        return gr[0], num
-
-    def get_sample_from_col(self, col):
-        sam = col.split('[')[1]
-        sam = sam.split(']')
-        return sam[0]
-
-    def recalc_avg(self, normal):
-        for name, row in normal.items():
-            stats = OrderedDict()
-            # for each group recalc the avg and std from areas
-            for group, nums in self.groups.items():
-                if group not in stats:  # group like c, s1, s2
-                    stats[group] = []
-                for num in nums:  # num replicates per group
-                    num_col = self.area_start + group + '-' + num + ']'
-                    stats[group].append(float(row[num_col]))
-            for group, val_lst in stats.items():
-                normal[name]['grouparea[' + group + ']'] = round(numpy.mean(val_lst), self.POST_NORMAL_ROUND)
-                normal[name]['arearsd[' + group + ']'] = round(numpy.std(val_lst), self.POST_NORMAL_ROUND)
-        return normal
+        # groups like c, s1, s2 with their replicate nums
+        return OrderedDict((group, list(nums)) for group, nums in
+                self.table.schema.groups.items())
+
+    def recalc_avg(self):
+        # recalc the avg and std of every group (c, s1, s2) from its area cols,
+        # with the area cols ordered by group one reduceat covers all groups
+        if not self.groups or not len(self.table):
+            return
+        schema = self.table.schema
+        group_cols = [schema.group_cols[group] for group in self.groups]
+        counts = numpy.array([len(cols) for cols in group_cols])
+        starts = numpy.concatenate(([0], numpy.cumsum(counts)[:-1]))
+        areas = self.table.values([c for cols in group_cols for c in cols])
+        avg = numpy.add.reduceat(areas, starts, axis=1) / counts
+        dev = (areas - numpy.repeat(avg, counts, axis=1)) ** 2
+        std = numpy.sqrt(numpy.add.reduceat(dev, starts, axis=1) / counts)
+        for g, group in enumerate(self.groups):
+            self.table.set_column('grouparea[' + group + ']', avg[:, g])
+            self.table.set_column('arearsd[' + group + ']', std[:, g])
+            self.table.set_round(['grouparea[' + group + ']',
+                'arearsd[' + group + ']'], self.settings.post_normal_round)
 
     def calc_class_stats(self):
-        # set to false if file not saved
-        sub_success = True
-        class_success = True
-        class_stats = {}
-        subclass_stats = {}
-        for name, row in self.rows.items():
-            # take subclass key from row
-            subclass_key = row['class']
-            if subclass_key in self.class_keys:
-                # get corresponding names from class_keys
-                subclass_name = self.class_keys[subclass_key]['subclass']
-                class_name = self.class_keys[subclass_key]['class']
-                # populate new subclasses and classes
-                if subclass_name not in subclass_stats:
-                    subclass_stats[subclass_name] = OrderedDict()
-                    if class_name not in class_stats:
-                        class_stats[class_name] = OrderedDict()
-                # add row to group areas for the class and subclass that
-                # correspond to the row
-                subclass_stats[subclass_name] = self.group_areas(row,
-                        subclass_stats[subclass_name])
-                class_stats[class_name] = self.group_areas(row,
-                        class_stats[class_name])
-        # write files
-        class_file = 'class_stats.csv'
-        class_path = self.root_path + class_file
-        subclass_file = 'subclass_stats.csv'
-        subclass_path = self.root_path + subclass_file
-        subclass_cols = self.stats_cols('subclass')
-        self.subclass_stats, self.subclass_dict = self.compute_stats('subclass', subclass_stats)
-        sub_success = self.write_csv(subclass_path, subclass_cols, self.subclass_dict.values())
-        self.paths_to_zip[subclass_file] = subclass_path
-        class_cols = self.stats_cols('class')
-        self.class_stats, self.class_dict = self.compute_stats('class', class_stats)
-        class_success = self.write_csv(class_path, class_cols, self.class_dict.values())
-        self.paths_to_zip[class_file] = class_path
-        return sub_success, class_success
+        # mean area per row for each group and whether the row has any area
+        # above 0 in the group, computed once for all rows
+        groups = list(self.groups.keys())
+        means = numpy.empty((len(self.table), len(groups)))
+        found = numpy.empty((len(self.table), len(groups)))
+        for j, key in enumerate(groups):
+            areas = self.table.group_values(key)
+            means[:, j] = numpy.mean(areas, axis=1)
+            found[:, j] = numpy.fmax.reduce(areas, axis=1) > 0.0
+        # the stats csvs are written into the zip with the results
+        names, codes = self.class_codes('subclass')
+        self.subclass_stats, self.subclass_dict = self.compute_stats(
+                'subclass', names, codes, means, found)
+        self.csvs_to_zip['subclass_stats.csv'] = (self.stats_cols('subclass'),
+                list(self.subclass_dict.values()))
+        names, codes = self.class_codes('class')
+        self.class_stats, self.class_dict = self.compute_stats('class',
+                names, codes, means, found)
+        self.csvs_to_zip['class_stats.csv'] = (self.stats_cols('class'),
+                list(self.class_dict.values()))
+
+    def class_codes(self, cat):
+        # map each row's class key through the lipid key once, names are in
+        # order of first appearance and rows not in the key get code -1
+        keys, first, inverse = numpy.unique(
+                self.table.column('class').astype(str), return_index=True,
+                return_inverse=True)
+        key_codes = numpy.full(len(keys), -1, dtype=numpy.intp)
+        names = []
+        codes = {}
+        for k in numpy.argsort(first, kind='stable'):
+            if keys[k] in self.class_keys:
+                name = self.class_keys[keys[k]][cat]
+                if name not in codes:
+                    codes[name] = len(names)
+                    names.append(name)
+                key_codes[k] = codes[name]
+        return names, key_codes[inverse.reshape(-1)]
 
     def stats_cols(self, cat):
         cols = [cat]
@@ -475,41 +588,40 @@ class LipidAnalysis:
             cols.append(g + ' std')
         return cols
 
-    def compute_stats(self, cat, stats):
-        rows = {}
-        for name, groups in stats.items():
-            row = {}
-            # fill the class type with the name
-            row[cat] = name
-            # for each group add stats based on grp area lists
-            for group, info in groups.items():
-                row[group + ' cnt'] = info['cnt']
-                avg = numpy.mean(info['grp_areas'])
-                gr_sum = numpy.sum(info['grp_areas'])
-                row[group + ' avg'] = avg
-                stats[name][group]['sum'] = gr_sum
-                stats[name][group]['avg'] = avg
-                std = numpy.std(info['grp_areas'])
-                row[group + ' std'] = std
-                stats[name][group]['std'] = std
+    def compute_stats(self, cat, names, codes, means, found):
+        # per class sums over the rows with that code, means and found are
+        # rows x groups as built in calc_class_stats
+        stats = OrderedDict()
+        rows = OrderedDict()
+        keep = codes >= 0
+        codes = codes[keep]
+        means = means[keep]
+        found = found[keep]
+        size = len(names)
+        n = numpy.bincount(codes, minlength=size)
+        cols = {}
+        for j, group in enumerate(self.groups):
+            cnt = numpy.bincount(codes, weights=found[:, j], minlength=size)
+            gr_sum = numpy.bincount(codes, weights=means[:, j], minlength=size)
+            with numpy.errstate(invalid='ignore', divide='ignore'):
+                avg = gr_sum / n
+                # population std from the deviations to each class avg
+                dev = (means[:, j] - avg[codes]) ** 2
+                std = numpy.sqrt(numpy.bincount(codes, weights=dev,
+                    minlength=size) / n)
+            cols[group] = (cnt.astype(int), gr_sum, avg, std)
+        for i, name in enumerate(names):
+            stats[name] = OrderedDict()
+            row = {cat: name}
+            for group, (cnt, gr_sum, avg, std) in cols.items():
+                stats[name][group] = {'cnt': int(cnt[i]), 'sum': gr_sum[i],
+                        'avg': avg[i], 'std': std[i]}
+                row[group + ' cnt'] = int(cnt[i])
+                row[group + ' avg'] = avg[i]
+                row[group + ' std'] = std[i]
             rows[name] = row
         return stats, rows
 
-    def group_areas(self, row, grp_info):
-        # add stats for each group from the row
-        for key in self.groups.keys():
-            if key not in grp_info:
-                # keep cnt and a list of group areas for group
-                grp_info[key] = {'cnt': 0, 'grp_areas': []}
-            areas = self.list_col_type(row, self.area_start + key)
-            if max(areas) > 0.0:
-                grp_info[key]['cnt'] += 1
-            # append one area per row group because there will be
-            # multiple rows in a subclass
-            # later another average is taken across all rows in the subclass
-            grp_info[key]['grp_areas'].append(numpy.mean(areas))
-        return grp_info
-
     def load_lipid_classes(self):
         classes = {}
         with open(self.lipid_class_path, 'r') as f:
@@ -525,6 +637,8 @@ class LipidAnalysis:
         return classes
 
     def class_plot(self):
+        from bokeh.embed import components
+        from bokeh.layouts import gridplot
         # reorganize class_stats data for plotting
         # TODO: can we avoid the need for this regoranization?
         data = {
@@ -580,13 +694,11 @@ class LipidAnalysis:
                 gr_data[group]['relative'].append(relative_percent)
                 data['relative'].append(relative_percent)
         data['lipid'] = list(data['lipid'])
-        pool = Pool(2)
-        bar_cnt = self.bar_chart(pool, gr_data, data, 'x', 'cnt', 'Number of Lipids', 'nb of lipids', data['lipid'], data['cnt'])
-        bar_sum = self.bar_chart(pool, gr_data, data, 'x', 'sum', 'Area', 'sum of area per group', data['lipid'], data['sum'], 'std')
-        bar_log_sum = self.bar_chart(pool, gr_data, data, 'x', 'sum', 'Area, log', 'sum of area per group', data['lipid'], data['sum'], 'std', 'log')
-        bar_relative = self.bar_chart(pool, gr_data, data, 'x', 'relative', 'Relative area', 'sum of area per group / total sum of area %', data['lipid'], data['relative'])
-        bar_log_relative = self.bar_chart(pool, gr_data, data, 'x', 'relative', 'Relative area, log', 'sum of area per group / total sum of area', data['lipid'], data['relative'], None, 'log')
-        pool.close()
+        bar_cnt = self.bar_chart(gr_data, data, 'x', 'cnt', 'Number of Lipids', 'nb of lipids', data['lipid'], data['cnt'])
+        bar_sum = self.bar_chart(gr_data, data, 'x', 'sum', 'Area', 'sum of area per group', data['lipid'], data['sum'], 'std')
+        bar_log_sum = self.bar_chart(gr_data, data, 'x', 'sum', 'Area, log', 'sum of area per group', data['lipid'], data['sum'], 'std', 'log')
+        bar_relative = self.bar_chart(gr_data, data, 'x', 'relative', 'Relative area', 'sum of area per group / total sum of area %', data['lipid'], data['relative'])
+        bar_log_relative = self.bar_chart(gr_data, data, 'x', 'relative', 'Relative area, log', 'sum of area per group / total sum of area', data['lipid'], data['relative'], None, 'log')
         bars = gridplot([
                 [bar_cnt],
                 [bar_sum],
@@ -597,7 +709,11 @@ class LipidAnalysis:
         script, div = components(bars)
         return script, div
 
-    def bar_chart(self, pool, gr_data, data, x, y, title, y_label, x_range, y_range, std=None, y_axis_type=None):
+    def bar_chart(self, gr_data, data, x, y, title, y_label, x_range, y_range, std=None, y_axis_type=None):
+        from bokeh.models import ColumnDataSource, FactorRange, Whisker
+        from bokeh.palettes import d3
+        from bokeh.plotting import figure
+        from lipidx import static_charts
         if y_axis_type:
             bottom = 0.0000000001
         else:
@@ -623,10 +739,11 @@ class LipidAnalysis:
         else:
             max_groups = 10
             category = 'Category10'
+        colors = d3[category][max_groups]
 
         for group, d in gr_data.items():
             bar.vbar(x = d[x], width = 0.5, top = d[y], bottom = bottom, legend
-                    = group, color = d3[category][max_groups][palette_key])
+                    = group, color = colors[palette_key])
             palette_key += 1
         # TODO: clear all somehow and select all
         bar.legend.click_policy = 'hide'
@@ -637,37 +754,40 @@ class LipidAnalysis:
         # save the png for the zip file
         chart_file_png = 'class_chart_' + title.replace(' ', '_').replace(',',
         '').lower() + '.png'
-        chart_path_png = self.root_path + chart_file_png
-        #pool.apply_async(export_png, (bar,), {'filename': chart_path_png})
-        export_png(bar, filename=chart_path_png)
-        # save paths to zip
-        self.paths_to_zip[chart_file_png] = chart_path_png
+        # the png is drawn without bokeh, the figure is only for the page
+        self.add_chart([chart_file_png], static_charts.bar_chart, (gr_data,
+            data, x, y, title, y_label, list(self.class_stats),
+            list(self.groups), colors, std, y_axis_type))
         return bar
 
     def calc_ratio(self, group1, group2):
+        from scipy.stats import ttest_ind
+        # ratios and p values for all rows at once
         ratio_name = group1 + '-over-' + group2
         ratio_col_name = 'ratio[' + ratio_name + ']'
-        for key, row in self.rows.items():
-            dividend = float(row[self.group_area_start + group1 + ']'])
-            divisor = float(row[self.group_area_start + group2 + ']'])
+        dividends = self.table.column(self.group_area_start + group1 + ']')
+        divisors = self.table.column(self.group_area_start + group2 + ']')
+        dividend_areas = self.table.group_values(group1)
+        divisor_areas = self.table.group_values(group2)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            ratios = dividends / divisors
             # set ratio artificaly to 0.1 or 10 if zero
-            if dividend == 0.0:
-                ratio = float(0.1)
-            elif divisor == 0.0:
-                ratio = float(10.0)
-            else:
-                ratio = dividend/divisor
-            self.rows[key][ratio_col_name] = ratio
-            self.rows[key]['log_ratio[' + ratio_name + ']'] = numpy.log2(ratio)
-            dividend_list = self.list_col_type(row, self.area_start + group1)
-            divisor_list = self.list_col_type(row, self.area_start + group2)
-            # if both lists are zero there is no significance so set to 1
-            if (numpy.sum(divisor_list) + numpy.sum(dividend_list)) == 0.0:
-                p = 1
-            else: # perform ttest to get p_value
-                t, p = ttest_ind(dividend_list, divisor_list, equal_var = False)
-            self.rows[key]['p_value[' + ratio_name + ']'] = p
-            self.rows[key]['log_p_value[' + ratio_name + ']'] = numpy.log10(p) * -1
+            ratios[divisors == 0.0] = 10.0
+            ratios[dividends == 0.0] = 0.1
+            # perform welch's ttest across the replicates of every row
+            t, p_values = ttest_ind(dividend_areas, divisor_areas, axis=1,
+                    equal_var=False)
+        p_values = numpy.array(p_values, dtype=numpy.float64)
+        # if both lists are zero there is no significance so set to 1
+        no_area = (numpy.sum(divisor_areas, axis=1) +
+                numpy.sum(dividend_areas, axis=1)) == 0.0
+        p_values[no_area] = 1.0
+        self.table.set_column(ratio_col_name, ratios)
+        self.table.set_column('log_ratio[' + ratio_name + ']', numpy.log2(ratios))
+        self.table.set_column('p_value[' + ratio_name + ']', p_values)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            self.table.set_column('log_p_value[' + ratio_name + ']',
+                    numpy.log10(p_values) * -1)
         return ratio_name
 
     def get_plots(self, form_data):
@@ -683,15 +803,65 @@ class LipidAnalysis:
                     form_data[group2].lower()))
         return plots
 
+    def thin_volcano_points(self, log_ratios, log_p_values, ratio_highlight,
+            pvalue_highlight):
+        # mask of the points drawn on the page, every point in the highlight
+        # boxes is kept, the rest are thinned on a grid so dense regions lose
+        # points and sparse ones keep them
+        keep = numpy.ones(len(log_ratios), dtype=bool)
+        if not self.volcano_max_points or len(keep) <= self.volcano_max_points:
+            return keep
+        with numpy.errstate(invalid='ignore'):
+            significant = ((log_p_values >= pvalue_highlight) &
+                    (numpy.abs(log_ratios) >= ratio_highlight))
+        finite = numpy.isfinite(log_ratios) & numpy.isfinite(log_p_values)
+        thin = numpy.flatnonzero(finite & ~significant)
+        budget = self.volcano_max_points - (len(keep) - len(thin))
+        if len(thin) <= budget:
+            return keep
+        # grid cell of each point that can be dropped
+        cells = numpy.zeros(len(thin), dtype=numpy.intp)
+        for values in (log_ratios[thin], log_p_values[thin]):
+            low, high = values.min(), values.max()
+            width = (high - low) / self.VOLCANO_GRID or 1.0
+            pos = numpy.minimum(((values - low) / width).astype(numpy.intp),
+                    self.VOLCANO_GRID - 1)
+            cells = cells * self.VOLCANO_GRID + pos
+        # random but repeatable rank of each point within its cell
+        shuffle = numpy.random.RandomState(0).permutation(len(thin))
+        order = shuffle[numpy.argsort(cells[shuffle], kind='stable')]
+        sorted_cells = cells[order]
+        starts = numpy.flatnonzero(numpy.r_[True, sorted_cells[1:] !=
+            sorted_cells[:-1]])
+        counts = numpy.diff(numpy.r_[starts, len(order)])
+        rank = numpy.arange(len(order)) - numpy.repeat(starts, counts)
+        # largest number of points per cell that fits in the budget, at least
+        # one so every occupied cell still shows
+        low, high = 1, counts.max()
+        while low < high:
+            mid = (low + high + 1) // 2
+            if numpy.minimum(counts, mid).sum() <= budget:
+                low = mid
+            else:
+                high = mid - 1
+        keep[thin[order[rank >= low]]] = False
+        return keep
+
     def volcano_plot(self, form_data):
+        from bokeh.embed import components
+        from bokeh.layouts import gridplot
+        from bokeh.models import BoxAnnotation, HoverTool, Legend
+        from bokeh.palettes import d3
+        from bokeh.plotting import figure
+        from lipidx import static_charts
         plots = self.get_plots(form_data)
         # set params for highlight of up and down reg regions
         ratio_highlight = form_data['ratio_highlight']
         pvalue_highlight = form_data['pvalue_highlight']
         if ratio_highlight <= 0:
-            ratio_highlight = LipidAnalysisForm.RATIO_HIGHLIGHT_DEFAULT
+            ratio_highlight = AnalysisSettings.RATIO_HIGHLIGHT
         if pvalue_highlight <= 0:
-            pvalue_highlight = LipidAnalysisForm.PVALUE_HIGHLIGHT_DEFAULT
+            pvalue_highlight = AnalysisSettings.PVALUE_HIGHLIGHT
         ratio_highlight = numpy.log2(ratio_highlight)
         pvalue_highlight = (numpy.log10(pvalue_highlight) * -1.0)
         plot_list = []
@@ -703,8 +873,15 @@ class LipidAnalysis:
         for (group1, group2) in plots:
             ratio_name = self.calc_ratio(group1, group2)
             data = {}
-            for key, row in self.rows.items():
-                subclass_key = row['class']
+            page_data = {}
+            log_ratios = self.table.column('log_ratio[' + ratio_name + ']')
+            log_p_values = self.table.column('log_p_value[' + ratio_name + ']')
+            classes = self.table.column('class')
+            # the page may only get a sample of the points, exports get all
+            on_page = self.thin_volcano_points(log_ratios, log_p_values,
+                    ratio_highlight, pvalue_highlight)
+            for i, key in enumerate(self.table.names):
+                subclass_key = classes[i]
                 class_name = self.class_keys[subclass_key]['class']
                 if class_name not in data:
                     data[class_name] = {
@@ -712,13 +889,20 @@ class LipidAnalysis:
                             'log2': [],
                             'p': []
                     }
+                    page_data[class_name] = {
+                            'lipid': [],
+                            'log2': [],
+                            'p': []
+                    }
                 # TODO: fix the lipid being used as labels
                 data[class_name]['lipid'].append(key)
-                data[class_name]['log2'].append(row['log_ratio[' + ratio_name +
-                    ']'])
-                data[class_name]['p'].append(row['log_p_value[' + ratio_name +
-                ']'])
-                y_range.append(row['log_p_value[' + ratio_name + ']'])
+                data[class_name]['log2'].append(log_ratios[i])
+                data[class_name]['p'].append(log_p_values[i])
+                if on_page[i]:
+                    page_data[class_name]['lipid'].append(key)
+                    page_data[class_name]['log2'].append(log_ratios[i])
+                    page_data[class_name]['p'].append(log_p_values[i])
+                y_range.append(log_p_values[i])
             p = figure(title = ratio_name, x_axis_label = 'log2(ratio)', y_axis_label = '-log10(p value)', width = 1000, height = 800, toolbar_location = "above")
             hover = HoverTool(tooltips=[
                 ('name', "@lipid"),
@@ -734,8 +918,9 @@ class LipidAnalysis:
 
             palette_key = 0
             legend_items = []
-            for class_name, source in data.items():
-                class_points = p.circle('log2', 'p', size=10, color=d3['Category20'][self.MAX_CLASSES][palette_key], alpha=0.5, source = source)
+            colors = d3['Category20'][self.MAX_CLASSES]
+            for class_name, source in page_data.items():
+                class_points = p.circle('log2', 'p', size=10, color=colors[palette_key], alpha=0.5, source = source)
                 legend_items.append((class_name, [class_points]))
                 palette_key += 1
             legend = Legend(
@@ -744,17 +929,15 @@ class LipidAnalysis:
                     location = (0, -30)
             )
             p.add_layout(legend, 'right')
-            p.output_backend = 'svg'
+            # webgl keeps the page responsive with many points, the svg and
+            # png files in the zip are drawn separately
+            p.output_backend = self.volcano_backend
             vol_file = 'volcano_' + ratio_name
             vol_file_svg = vol_file + '.svg'
             vol_file_png = vol_file + '.png'
-            vol_path_svg = self.root_path + vol_file_svg
-            vol_path_png = self.root_path + vol_file_png
-            export_svgs(p, filename=vol_path_svg)
-            export_png(p, filename=vol_path_png)
-            # save paths to zip
-            self.paths_to_zip[vol_file_svg] = vol_path_svg
-            self.paths_to_zip[vol_file_png] = vol_path_png
+            self.add_chart([vol_file_svg, vol_file_png],
+                    static_charts.volcano_plot, (ratio_name, data, colors,
+                    ratio_highlight, pvalue_highlight))
             plot_list.append([p])
         if plot_list:
             script, div = components(gridplot(plot_list))
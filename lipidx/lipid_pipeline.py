@@ -0,0 +1,174 @@
+import logging
+import pickle
+from lipidx.lipid_analysis import LipidAnalysis
+from lipidx.settings import AnalysisSettings
+from lipidx.stage_report import StageReport
+
+logger = logging.getLogger(__name__)
+
+
+class LipidPipeline:
+    # stages of a lipid analysis in the order they run, with the params each
+    # one uses and whether its output is kept in the stage cache, a stage key
+    # is the key of the stage before it plus its own params so a changed
+    # param only reruns the stages from the first one that uses it
+    STAGES = (
+        ('read', ('debug',), True),
+        ('remove_rejects', (), False),
+        ('group_ions', ('group_ions_within',), True),
+        ('filter_rows', ('retention_time_filter', 'group_pq_filter',
+            'group_sn_filter', 'group_area_filter', 'group_height_filter'),
+            True),
+        ('subtract_blank', ('blank', 'mult_factor'), False),
+        ('remove_columns', ('remove_cols',), False),
+        ('normalize', ('normalize', 'normal_*'), True),
+        ('class_stats', ('class_stats',), True),
+        ('volcano', ('group1', 'group2', 'group3', 'group4', 'group5',
+            'group6', 'ratio_highlight', 'pvalue_highlight'), False),
+    )
+    STATE_FILE = 'state.pickle'
+    NORMAL_GROUPS = ('c', 's1', 's2', 's3', 's4', 's5', 's6', 's7', 's8',
+            's9', 's10')
+
+    def __init__(self, cache, paths, input_key, params, root_path=None,
+            report=None, settings=None):
+        # cache is a ResultCache, input_key the file_key of paths, results
+        # are written to root_path, the run's dir, report a StageReport and
+        # settings the AnalysisSettings, those of the flask app if not given
+        self.cache = cache
+        self.paths = paths
+        self.input_key = input_key
+        self.params = params
+        self.root_path = root_path
+        self.report = report or StageReport()
+        self.settings = settings or AnalysisSettings.current(root_path)
+        # page parts made by the stages, e.g. the bokeh script and div
+        self.context = {}
+
+    @classmethod
+    def default_params(cls):
+        # params of the lipid analysis form left at its defaults, for runs
+        # without the form such as batch runs and benchmarks, the form is
+        # imported here as it imports flask
+        from lipidx.forms import LipidAnalysisForm as form
+        params = {'debug': False,
+                'group_ions_within': form.ION_GROUP_WITHIN_DEFAULT,
+                'retention_time_filter': form.RET_TIME_DEFAULT,
+                'group_pq_filter': form.GROUP_PQ_DEFAULT,
+                'group_sn_filter': form.GROUP_SN_DEFAULT,
+                'group_area_filter': form.GROUP_AREA_DEFAULT,
+                'group_height_filter': form.GROUP_HEIGHT_DEFAULT,
+                'blank': '', 'mult_factor': form.MULT_FACTOR_DEFAULT,
+                'remove_cols': ', '.join(form.COLS_TO_REMOVE),
+                'normalize': 'none', 'class_stats': True,
+                'ratio_highlight': form.RATIO_HIGHLIGHT_DEFAULT,
+                'pvalue_highlight': form.PVALUE_HIGHLIGHT_DEFAULT}
+        params.update(('normal_' + group, '') for group in cls.NORMAL_GROUPS)
+        params.update(('group%d' % i, '') for i in range(1, 7))
+        return params
+
+    def stage_params(self, fields):
+        # a field ending in * takes all params that start with it
+        params = {}
+        for field in fields:
+            if field.endswith('*'):
+                params.update((k, v) for k, v in self.params.items() if
+                        k.startswith(field[:-1]))
+            else:
+                params[field] = self.params.get(field)
+        return params
+
+    def stage_keys(self):
+        keys = []
+        key = self.input_key
+        for name, fields, save in self.STAGES:
+            key = self.cache.key(key, {'stage': name,
+                'params': self.stage_params(fields)})
+            keys.append(key)
+        return keys
+
+    def run(self):
+        keys = self.stage_keys()
+        la = None
+        start = 0
+        if self.cache.max_bytes:
+            # start after the last stage with a cached output
+            for i in reversed(range(len(self.STAGES))):
+                name, fields, save = self.STAGES[i]
+                if save:
+                    la = self.load(keys[i])
+                    if la is not None:
+                        self.report.cached(name, la)
+                        start = i + 1
+                        break
+        for i in range(start, len(self.STAGES)):
+            name, fields, save = self.STAGES[i]
+            la = self.report.run(name, getattr(self, 'stage_' + name), la)
+            if save and self.cache.max_bytes:
+                self.save(keys[i], name, la)
+        return la
+
+    def load(self, key):
+        context, entry = self.cache.get(key)
+        if context is None:
+            return None
+        try:
+            la = LipidAnalysis.load_snapshot(entry + '/' + self.STATE_FILE)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+        # the cached stage may be from another run's dir or settings
+        la.set_settings(self.settings)
+        la.set_root_path(self.root_path)
+        self.context = context['page']
+        return la
+
+    def save(self, key, name, la):
+        try:
+            self.cache.put(key, {'stage': name, 'page': self.context},
+                    data={self.STATE_FILE: pickle.dumps(la)})
+        except OSError:
+            logger.exception('Could not cache %s stage', name)
+
+    def stage_read(self, la):
+        la = LipidAnalysis(self.paths, self.params.get('debug', False),
+                self.root_path, self.settings)
+        return la
+
+    def stage_remove_rejects(self, la):
+        la.remove_rejects()
+        return la
+
+    def stage_group_ions(self, la):
+        la.group_ions(self.params['group_ions_within'])
+        return la
+
+    def stage_filter_rows(self, la):
+        la.filter_rows(self.params['retention_time_filter'],
+                self.params['group_pq_filter'],
+                self.params['group_sn_filter'],
+                self.params['group_area_filter'],
+                self.params['group_height_filter']
+        )
+        return la
+
+    def stage_subtract_blank(self, la):
+        la.subtract_blank(self.params['blank'], self.params['mult_factor'])
+        return la
+
+    def stage_remove_columns(self, la):
+        la.remove_columns(self.params['remove_cols'])
+        return la
+
+    def stage_normalize(self, la):
+        la.normalize(self.params)
+        return la
+
+    def stage_class_stats(self, la):
+        if self.params['class_stats']:
+            la.calc_class_stats()
+            self.context['class_script'], self.context['class_div'] = la.class_plot()
+        return la
+
+    def stage_volcano(self, la):
+        self.context['volcano_script'], self.context['volcano_div'] = la.volcano_plot(self.params)
+        return la
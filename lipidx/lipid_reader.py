@@ -0,0 +1,99 @@
+import re
+import numpy
+from itertools import islice
+from lipidx.lipid_table import LipidTable
+
+
+class LipidSearchReader:
+    # number of data lines converted to arrays at a time
+    CHUNK_ROWS = 10000
+    SKIP_STARTS = ('#', '\t', '\n', '')
+
+    def __init__(self, path, chunk_rows=CHUNK_ROWS):
+        self.path = path
+        self.chunk_rows = chunk_rows
+        # filled in read_header
+        self.cols = []
+        self.set_name = True
+        self.split = None
+
+    def read_header(self, f):
+        # skip the # metadata block, the first line after it is the header
+        for ln in f:
+            if ln[:1] not in self.SKIP_STARTS:
+                ln = ln.replace('\n', '')
+                self.split = self.get_split(ln)
+                file_cols = self.split(ln)
+                # Only add name and ret_time if not there
+                # for volcano only it will already be there
+                if 'name' in file_cols:
+                    self.set_name = False
+                    cols = file_cols
+                else:
+                    cols = ['name', 'ret_time']  # these two columns added first
+                    cols.extend(file_cols)
+                self.cols = [x.lower() for x in cols]
+                break
+        return self.cols
+
+    def header(self):
+        # read only the header, used to find the cols common to several files
+        # before any of them are parsed
+        with open(self.path, 'r') as f:
+            return self.read_header(f)
+
+    def get_split(self, header):
+        # LipidSearch exports are tab separated and our results are csv, use
+        # the faster str.split unless the header has both separators
+        if '\t' in header and ',' in header:
+            pattern = re.compile('\t|,')
+            return pattern.split
+        sep = '\t' if '\t' in header else ','
+        return lambda ln: ln.split(sep)
+
+    def chunks(self, f):
+        skip = self.SKIP_STARTS
+        split = self.split
+        width = len(self.cols)
+        # filler vals for name and ret_time
+        filler = ['', ''] if self.set_name else []
+        while True:
+            lines = list(islice(f, self.chunk_rows))
+            if not lines:
+                break
+            rows = []
+            for ln in lines:
+                if ln[:1] in skip:
+                    continue
+                row = filler + split(ln.replace('\n', ''))
+                if len(row) != width:
+                    # short rows are padded so the blocks are rectangular
+                    row = (row + [''] * width)[:width]
+                rows.append(row)
+            if rows:
+                yield rows
+
+    def read(self, keep=None):
+        # keep limits the table to a subset of the cols, in file order
+        text = []
+        numeric = []
+        with open(self.path, 'r') as f:
+            cols = self.read_header(f)
+            if keep is not None:
+                keep = set(keep)
+                cols = [c for c in cols if c in keep]
+            # col positions are resolved once for the whole file
+            pos = {c: i for i, c in enumerate(self.cols)}
+            text_idx = [pos[c] for c in cols if not LipidTable.is_numeric_col(c)]
+            num_idx = [pos[c] for c in cols if LipidTable.is_numeric_col(c)]
+            for rows in self.chunks(f):
+                cells = numpy.empty((len(rows), len(self.cols)), dtype=object)
+                cells[:] = rows
+                text.append(cells[:, text_idx])
+                # numeric cols are converted to float for the whole chunk
+                numeric.append(LipidTable.to_float(cells[:, num_idx]))
+        if not text:
+            return LipidTable([], cols, None, None)
+        text = numpy.concatenate(text)
+        numeric = numpy.concatenate(numeric)
+        return LipidTable([''] * len(text), cols, text, numeric)
@@ -0,0 +1,320 @@
+import numpy
+from collections import OrderedDict
+
+
+class LipidSchema:
+    # the prefix of a col is the part before the [ and the sample is inside
+    # it, e.g. area[s1-2] has prefix area, sample s1-2, group s1, replicate 2
+    SAMPLE_PREFIX = 'area'
+
+    def __init__(self, cols, num_index):
+        self.prefixes = OrderedDict()
+        self.samples = {}
+        self.col_groups = {}
+        # group -> replicate nums and group -> area cols, for sample groups
+        self.groups = OrderedDict()
+        self.group_cols = OrderedDict()
+        self.add(cols)
+        self.reindex(num_index)
+
+    @staticmethod
+    def split_col(col):
+        # 'area[s1-2]' -> ('area', 's1-2'), 'ret_time' -> ('ret_time', None)
+        if '[' not in col:
+            return col, None
+        prefix, rest = col.split('[', 1)
+        return prefix, rest.split(']')[0]
+
+    def add(self, cols):
+        for col in cols:
+            prefix, sample = self.split_col(col)
+            self.prefixes.setdefault(prefix, []).append(col)
+            if sample is None:
+                continue
+            self.samples[col] = sample
+            if prefix == self.SAMPLE_PREFIX and '-' in sample:
+                group, num = sample.split('-', 1)
+                self.col_groups[col] = (group, num)
+                self.groups.setdefault(group, []).append(num)
+                self.group_cols.setdefault(group, []).append(col)
+        self.index_cache = {}
+
+    def remove(self, cols):
+        # drop cols from the lookups without rebuilding them
+        for col in cols:
+            prefix, sample = self.split_col(col)
+            if col in self.prefixes.get(prefix, []):
+                self.prefixes[prefix].remove(col)
+                if not self.prefixes[prefix]:
+                    del self.prefixes[prefix]
+            self.samples.pop(col, None)
+            if col in self.col_groups:
+                group, num = self.col_groups.pop(col)
+                self.groups[group].remove(num)
+                self.group_cols[group].remove(col)
+                if not self.group_cols[group]:
+                    del self.groups[group]
+                    del self.group_cols[group]
+        self.index_cache = {}
+
+    def reindex(self, num_index):
+        # positions in the numeric block change when cols are added or dropped
+        self.num_index = num_index
+        self.index_cache = {}
+
+    def cols(self, prefix):
+        return self.prefixes.get(prefix, [])
+
+    def index(self, prefix):
+        # numeric block positions of all cols with prefix
+        key = ('prefix', prefix)
+        if key not in self.index_cache:
+            self.index_cache[key] = numpy.array([self.num_index[c] for c in
+                    self.cols(prefix)], dtype=numpy.intp)
+        return self.index_cache[key]
+
+    def group_index(self, group):
+        # numeric block positions of the area cols of one sample group
+        key = ('group', group)
+        if key not in self.index_cache:
+            self.index_cache[key] = numpy.array([self.num_index[c] for c in
+                    self.group_cols.get(group, [])], dtype=numpy.intp)
+        return self.index_cache[key]
+
+
+class LipidTable:
+    # cols that start with one of these prefixes are stored as float64 in the
+    # numeric block, all other cols are kept as text
+    NUMERIC_PREFIXES = ('area[', 'grouparea[', 'arearsd[', 'grouppq[',
+            'groups/n[', 'groupheight[', 'grouptoppos[', 'ratio[',
+            'log_ratio[', 'p_value[', 'log_p_value[')
+    NUMERIC_COLS = ('ret_time', 'avg_blank')
+    MISSING = 'NaN'
+    # text cells are joined on this when a table is sent to another process
+    TEXT_SEP = '\x1f'
+
+    def __init__(self, names, cols, text, numeric):
+        # names is the row index, cols keeps the original col order
+        self.names = numpy.asarray(names, dtype=object)
+        self.cols = list(cols)
+        self.text_cols = [c for c in self.cols if not self.is_numeric_col(c)]
+        self.num_cols = [c for c in self.cols if self.is_numeric_col(c)]
+        self.text = self.as_block(text, len(self.text_cols), object)
+        self.numeric = self.as_block(numeric, len(self.num_cols),
+                numpy.float64)
+        self.index_cols()
+        self.schema = LipidSchema(self.cols, self.num_index)
+        # decimals numeric cols are rounded to when converted to rows
+        self.round_to = {}
+
+    @classmethod
+    def from_lists(cls, names, cols, values):
+        # values is a list of rows, each a list of strings in the order of cols
+        cols = list(cols)
+        width = len(cols)
+        # short rows are padded so the blocks are rectangular
+        values = [v if len(v) == width else (list(v) + [''] * width)[:width]
+                for v in values]
+        cells = numpy.empty((len(values), width), dtype=object)
+        if values:
+            cells[:] = values
+        text_idx = [i for i, c in enumerate(cols) if not cls.is_numeric_col(c)]
+        num_idx = [i for i, c in enumerate(cols) if cls.is_numeric_col(c)]
+        text = cells[:, text_idx]
+        numeric = cls.to_float(cells[:, num_idx])
+        return cls(names, cols, text, numeric)
+
+    @classmethod
+    def from_rows(cls, rows):
+        # build a table from an OrderedDict of dict rows keyed on name
+        cols = []
+        seen = set()
+        for row in rows.values():
+            for col in row:
+                if col not in seen:
+                    seen.add(col)
+                    cols.append(col)
+        values = [[row.get(c, '') for c in cols] for row in rows.values()]
+        return cls.from_lists(list(rows.keys()), cols, values)
+
+    @classmethod
+    def concat(cls, tables, cols):
+        # stack tables row wise keeping only cols, which all tables must have
+        text_cols = [c for c in cols if not cls.is_numeric_col(c)]
+        num_cols = [c for c in cols if cls.is_numeric_col(c)]
+        names = numpy.concatenate([t.names for t in tables])
+        text = numpy.concatenate([t.text[:, [t.text_index[c] for c in text_cols]]
+                for t in tables])
+        numeric = numpy.concatenate([t.numeric[:, [t.num_index[c] for c in
+                num_cols]] for t in tables])
+        return cls(names, cols, text, numeric)
+
+    @classmethod
+    def empty(cls):
+        return cls([], [], None, None)
+
+    @classmethod
+    def is_numeric_col(cls, col):
+        return col in cls.NUMERIC_COLS or col.startswith(cls.NUMERIC_PREFIXES)
+
+    def as_block(self, block, width, dtype):
+        shape = (len(self.names), width)
+        if block is None:
+            return numpy.empty(shape, dtype=dtype)
+        return numpy.asarray(block, dtype=dtype).reshape(shape)
+
+    @staticmethod
+    def to_float(cells):
+        # empty cells become nan, convert the whole block at once and only
+        # fall back to cell by cell if there is something unparsable in it
+        cells = numpy.where(cells == '', 'nan', cells)
+        try:
+            return cells.astype(numpy.float64)
+        except (ValueError, TypeError):
+            out = numpy.empty(cells.shape, dtype=numpy.float64)
+            for i, val in numpy.ndenumerate(cells):
+                try:
+                    out[i] = float(val)
+                except (ValueError, TypeError):
+                    out[i] = numpy.nan
+            return out
+
+    def __getstate__(self):
+        # one joined string pickles much faster than an object array of
+        # strings, keep the array if a cell is not a string or has the sep
+        state = self.__dict__.copy()
+        try:
+            joined = self.TEXT_SEP.join(self.text.ravel().tolist())
+        except TypeError:
+            return state
+        if joined.count(self.TEXT_SEP) == max(self.text.size - 1, 0):
+            state['text'] = (joined, self.text.shape)
+        return state
+
+    def __setstate__(self, state):
+        if isinstance(state['text'], tuple):
+            joined, shape = state['text']
+            text = numpy.empty(shape, dtype=object)
+            if text.size:
+                text.ravel()[:] = joined.split(self.TEXT_SEP)
+            state['text'] = text
+        self.__dict__.update(state)
+
+    def index_cols(self):
+        self.text_index = {c: i for i, c in enumerate(self.text_cols)}
+        self.num_index = {c: i for i, c in enumerate(self.num_cols)}
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, col):
+        return col in self.text_index or col in self.num_index
+
+    def prefix_values(self, prefix):
+        # numeric sub matrix for all cols with prefix, e.g. area or grouppq
+        return self.numeric[:, self.schema.index(prefix)]
+
+    def group_values(self, group):
+        # area sub matrix for the replicates of a sample group
+        return self.numeric[:, self.schema.group_index(group)]
+
+    def column(self, col):
+        if col in self.num_index:
+            return self.numeric[:, self.num_index[col]]
+        return self.text[:, self.text_index[col]]
+
+    def values(self, cols):
+        # numeric sub matrix for cols, rows x cols
+        idx = [self.num_index[c] for c in cols]
+        return self.numeric[:, idx]
+
+    def set_values(self, cols, values):
+        idx = [self.num_index[c] for c in cols]
+        self.numeric[:, idx] = values
+
+    def set_column(self, col, values):
+        # overwrite a numeric col or append it to the end of the table
+        values = numpy.asarray(values, dtype=numpy.float64)
+        if col in self.num_index:
+            self.numeric[:, self.num_index[col]] = values
+        else:
+            self.cols.append(col)
+            self.num_cols.append(col)
+            self.num_index[col] = len(self.num_cols) - 1
+            self.numeric = numpy.column_stack((self.numeric, values))
+            self.schema.add([col])
+
+    def set_text_column(self, col, values):
+        values = numpy.asarray(values, dtype=object)
+        if col in self.text_index:
+            self.text[:, self.text_index[col]] = values
+        else:
+            self.cols.append(col)
+            self.text_cols.append(col)
+            self.text_index[col] = len(self.text_cols) - 1
+            self.text = numpy.column_stack((self.text, values))
+            self.schema.add([col])
+
+    def set_round(self, cols, decimals):
+        # values keep full precision, rounding is only applied on output
+        for col in cols:
+            self.round_to[col] = decimals
+
+    def select(self, rows):
+        # keep only the rows in a boolean mask or a list of row positions
+        self.names = self.names[rows]
+        self.text = self.text[rows]
+        self.numeric = self.numeric[rows]
+
+    def keep_columns(self, cols):
+        keep = set(cols)
+        self.schema.remove([c for c in self.cols if c not in keep])
+        self.cols = [c for c in self.cols if c in keep]
+        text_idx = [self.text_index[c] for c in self.text_cols if c in keep]
+        num_idx = [self.num_index[c] for c in self.num_cols if c in keep]
+        self.text_cols = [c for c in self.text_cols if c in keep]
+        self.num_cols = [c for c in self.num_cols if c in keep]
+        self.text = self.text[:, text_idx]
+        self.numeric = self.numeric[:, num_idx]
+        self.index_cols()
+        self.schema.reindex(self.num_index)
+
+    def drop_columns(self, cols):
+        drop = set(cols)
+        self.keep_columns([c for c in self.cols if c not in drop])
+
+    def to_rows(self, order=None):
+        # convert back to dict rows keyed on name
+        if order is None:
+            order = range(len(self))
+        order = list(order)
+        return OrderedDict(zip((self.names[i] for i in order),
+            self.iter_rows(order)))
+
+    def iter_rows(self, order=None):
+        # dict rows one at a time so they can be streamed to a file
+        if order is None:
+            order = range(len(self))
+        getters = []
+        for col in self.cols:
+            if col in self.num_index:
+                getters.append((col, True, self.num_index[col],
+                    self.round_to.get(col)))
+            else:
+                getters.append((col, False, self.text_index[col], None))
+        for i in order:
+            text = self.text[i]
+            numeric = self.numeric[i].tolist()
+            row = OrderedDict()
+            for col, is_num, j, decimals in getters:
+                if is_num:
+                    val = numeric[j]
+                    if val != val:
+                        # missing values are written the way LipidSearch does
+                        val = self.MISSING
+                    elif decimals is not None:
+                        val = round(val, decimals)
+                    row[col] = val
+                else:
+                    row[col] = text[j]
+            yield row
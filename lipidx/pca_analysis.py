@@ -1,20 +1,20 @@
 import numpy
 import re
 from collections import OrderedDict
-from bokeh.plotting import figure
-from bokeh.models import Legend
-from bokeh.palettes import d3
-from sklearn.decomposition import PCA
-from sklearn.preprocessing import StandardScaler
-from bokeh.models import HoverTool
+# bokeh and sklearn are imported in pca, they are slow to import
 
 
 class PCAAnalysis:
 
-    def __init__(self, path):
+    def __init__(self, path, store=None):
         self.path = path
         self.area_start = 'area['
-        self.rows = self.get_rows_from_files()
+        # results this app wrote are loaded from store, a TableStore, as a
+        # table, other files are parsed into rows
+        self.table = store.get(path) if store else None
+        self.rows = None
+        if self.table is None:
+            self.rows = self.get_rows_from_files()
 
     def get_rows_from_files(self):
         rows = OrderedDict()
@@ -34,6 +34,11 @@ class PCAAnalysis:
         return rows
 
     def pca(self):
+        from bokeh.models import HoverTool, Legend
+        from bokeh.palettes import d3
+        from bokeh.plotting import figure
+        from sklearn.decomposition import PCA
+        from sklearn.preprocessing import StandardScaler
         cols = self.get_sample_cols()
         data = self.get_sample_data(cols)
         sample_grps = self.get_sample_groups(cols)
@@ -74,6 +79,8 @@ class PCAAnalysis:
         return p
 
     def get_sample_cols(self):
+        if self.table is not None:
+            return list(self.table.schema.cols('area'))
         area_cols = self.get_cols(self.area_start)
         # if using template instead of lipid_analysis results then use all cols
         # but name
@@ -82,6 +89,8 @@ class PCAAnalysis:
         return area_cols
 
     def get_sample_data(self, area_cols):
+        if self.table is not None:
+            return self.table.values(area_cols)
         sample_grps = {}
         data = []
         for row in self.rows.values():
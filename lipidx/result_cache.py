@@ -0,0 +1,133 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+
+class ResultCache:
+    # results of earlier runs keyed on a hash of the uploaded files and the
+    # form params, each entry is a dir with the page context and the files
+    # to download, the least recently used are removed above max_bytes
+    CONTEXT_FILE = 'context.json'
+    # page parts of a lipid analysis kept with its results
+    RESULTS_CONTEXT = ('class_script', 'class_div', 'volcano_script',
+            'volcano_div', 'chart_errors')
+    READ_SIZE = 1024 * 1024
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+
+    @classmethod
+    def file_digest(cls, path):
+        # sha256 of a file, read in blocks
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(cls.READ_SIZE), b''):
+                digest.update(block)
+        return digest
+
+    @classmethod
+    def file_key(cls, paths):
+        h = hashlib.sha256()
+        for path in paths:
+            # each file is hashed on its own so file order is part of the key
+            h.update(cls.file_digest(path).digest())
+        return h.hexdigest()
+
+    @staticmethod
+    def key(input_key, params):
+        # input_key is a file_key or the key of an earlier result
+        h = hashlib.sha256(input_key.encode())
+        h.update(json.dumps(params, sort_keys=True, default=str).encode())
+        return h.hexdigest()
+
+    def entry_dir(self, key):
+        return os.path.join(self.root, key)
+
+    def get(self, key):
+        # page context and dir with the cached files, None on a miss
+        entry = self.entry_dir(key)
+        try:
+            with open(os.path.join(entry, self.CONTEXT_FILE)) as f:
+                context = json.load(f)
+        except (OSError, ValueError):
+            return None, None
+        # mtime of the dir marks when the entry was last used
+        try:
+            os.utime(entry)
+        except OSError:
+            # evicted by another process since the context was read
+            return None, None
+        return context, entry
+
+    def put(self, key, context, paths=None, data=None):
+        # paths are name -> path of the files to keep with the context, data
+        # is name -> bytes for files that are only in memory
+        if not self.max_bytes:
+            return None
+        entry = self.entry_dir(key)
+        if os.path.exists(entry):
+            # same key means the same results, e.g. two identical requests
+            os.utime(entry)
+            return entry
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        # built in a temp dir and renamed so a half written entry is never seen
+        tmp = tempfile.mkdtemp(dir=self.root, prefix='.tmp')
+        try:
+            for name, path in (paths or {}).items():
+                shutil.copyfile(path, os.path.join(tmp, name))
+            for name, content in (data or {}).items():
+                with open(os.path.join(tmp, name), 'wb') as f:
+                    f.write(content)
+            with open(os.path.join(tmp, self.CONTEXT_FILE), 'w') as f:
+                json.dump(context, f)
+            os.rename(tmp, entry)
+        except OSError:
+            # another request stored the same key first or the disk is full
+            shutil.rmtree(tmp, ignore_errors=True)
+            if not os.path.exists(entry):
+                raise
+        self.evict()
+        return entry
+
+    def put_results(self, key, la, context):
+        # the zip of a finished lipid analysis, or the snapshot it is built
+        # from in lazy mode, with the page parts of its context, a full disk
+        # only means the results are not cached
+        files = {}
+        if os.path.exists(la.zip_path):
+            files[la.zip_file] = la.zip_path
+        elif os.path.exists(la.snapshot_path):
+            files[la.SNAPSHOT_FILE] = la.snapshot_path
+        cached = {k: context[k] for k in self.RESULTS_CONTEXT if k in context}
+        try:
+            return self.put(key, cached, files)
+        except OSError:
+            logger.exception("Could not cache Lipid Analysis results")
+            return None
+
+    def entry_size(self, entry):
+        return sum(os.path.getsize(os.path.join(entry, name)) for name in
+                os.listdir(entry))
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.root):
+            entry = os.path.join(self.root, name)
+            if name.startswith('.tmp') or not os.path.isdir(entry):
+                continue
+            entries.append((os.path.getmtime(entry), self.entry_size(entry),
+                entry))
+        total = sum(size for _, size, _ in entries)
+        # oldest first
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
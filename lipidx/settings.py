@@ -0,0 +1,94 @@
+import os
+from lipidx.table_store import TableStore
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+
+
+class AnalysisSettings:
+    # everything a lipid analysis needs besides its files and params, so it
+    # runs without the flask app, e.g. in worker processes and scripts, the
+    # defaults are those of config.py
+    ROUND_TO = 2
+    POST_NORMAL_ROUND = 8
+    # max worker processes used to parse uploaded files after the first
+    READ_PROCESSES = 2
+    # worker processes used to draw the chart images
+    CHART_PROCESSES = 2
+    # seconds to wait for a chart drawn in a worker, e.g. one that was
+    # killed, before it is left out of the zip, 0 to wait for as long as
+    # it takes
+    CHART_TIMEOUT = 300
+    # volcano highlight boxes used when the form gives none, also the
+    # defaults of the forms
+    RATIO_HIGHLIGHT = 2.0
+    PVALUE_HIGHLIGHT = 0.05
+    # page volcano plots: bokeh backend and max points drawn, 0 for all
+    VOLCANO_BACKEND = 'webgl'
+    VOLCANO_MAX_POINTS = 0
+    # deflate level of the results zip
+    ZIP_COMPRESS_LEVEL = 6
+    # zips built on download are kept in memory up to this size
+    ZIP_SPOOL_SIZE = 32 * 1024 * 1024
+    # config names of the settings that can be set in the app config
+    CONFIG = (('chart_processes', 'CHART_PROCESSES'),
+            ('chart_timeout', 'CHART_TIMEOUT'),
+            ('volcano_backend', 'VOLCANO_BACKEND'),
+            ('volcano_max_points', 'VOLCANO_MAX_POINTS'),
+            ('zip_level', 'ZIP_COMPRESS_LEVEL'),
+            ('zip_spool_size', 'ZIP_SPOOL_SIZE'))
+
+    def __init__(self, root_path=None, lipid_key_path=None, round_to=ROUND_TO,
+            post_normal_round=POST_NORMAL_ROUND,
+            read_processes=READ_PROCESSES, chart_processes=CHART_PROCESSES,
+            chart_timeout=CHART_TIMEOUT,
+            volcano_backend=VOLCANO_BACKEND,
+            volcano_max_points=VOLCANO_MAX_POINTS,
+            zip_level=ZIP_COMPRESS_LEVEL, zip_spool_size=ZIP_SPOOL_SIZE,
+            table_store_root=None, table_store_size=0):
+        # root_path is the dir result files are written to when a run has
+        # no dir of its own, results tables are kept in binary form under
+        # table_store_root up to table_store_size bytes, 0 to turn it off
+        self.root_path = root_path or os.path.join(BASE_DIR, 'files/')
+        self.lipid_key_path = lipid_key_path or os.path.join(BASE_DIR,
+                'lipidKey.csv')
+        self.round_to = round_to
+        self.post_normal_round = post_normal_round
+        self.read_processes = read_processes
+        self.chart_processes = chart_processes
+        self.chart_timeout = chart_timeout
+        self.volcano_backend = volcano_backend
+        self.volcano_max_points = volcano_max_points
+        self.zip_level = zip_level
+        self.zip_spool_size = zip_spool_size
+        self.table_store_root = table_store_root
+        self.table_store_size = table_store_size
+
+    @classmethod
+    def from_config(cls, config, root_path=None):
+        # settings from a flask config, or any dict with the same names
+        settings = cls(root_path or config.get('UPLOAD_FOLDER'))
+        if config.get('UPLOAD_FOLDER'):
+            settings.table_store_root = config['UPLOAD_FOLDER'] + 'tables/'
+            settings.table_store_size = config.get('TABLE_STORE_SIZE', 0)
+        if config.get('BASE_DIR'):
+            settings.lipid_key_path = os.path.join(config['BASE_DIR'],
+                    'lipidKey.csv')
+        for name, key in cls.CONFIG:
+            if config.get(key) is not None:
+                setattr(settings, name, config[key])
+        return settings
+
+    def table_store(self):
+        # None when results tables are not kept
+        if not self.table_store_root or not self.table_store_size:
+            return None
+        return TableStore(self.table_store_root, self.table_store_size)
+
+    @classmethod
+    def current(cls, root_path=None):
+        # settings of the flask app in use, the defaults outside of one,
+        # flask is only imported here so the analysis doesn't need it
+        from flask import current_app, has_app_context
+        if has_app_context():
+            return cls.from_config(current_app.config, root_path)
+        return cls(root_path)
@@ -0,0 +1,76 @@
+import json
+import logging
+import time
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+
+class StageReport:
+    # wall time, cpu time, peak memory and table size of each stage of a run,
+    # memory is traced only if asked for as it slows every allocation, only
+    # allocations of this process are seen, not those of read or chart workers
+    FILE = 'stage_report.json'
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.records = []
+
+    def shape(self, la):
+        if la is None:
+            return None, None
+        return len(la.table), len(la.table.cols)
+
+    def run(self, name, func, la=None):
+        # func(la) as stage name, la is the analysis before the stage, an
+        # analysis returned by func the one after it
+        record = {'stage': name, 'cached': False}
+        record['rows_before'], record['cols_before'] = self.shape(la)
+        started = False
+        base = 0
+        if self.trace_memory:
+            if tracemalloc.is_tracing():
+                tracemalloc.reset_peak()
+                base = tracemalloc.get_traced_memory()[0]
+            else:
+                tracemalloc.start()
+                started = True
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            result = func(la)
+        finally:
+            record['wall_time'] = time.perf_counter() - wall
+            record['cpu_time'] = time.process_time() - cpu
+            # peak above what was allocated when the stage started
+            record['peak_memory'] = None
+            if self.trace_memory:
+                record['peak_memory'] = tracemalloc.get_traced_memory()[1] - base
+                if started:
+                    tracemalloc.stop()
+        after = result if hasattr(result, 'table') else la
+        record['rows_after'], record['cols_after'] = self.shape(after)
+        self.add(record)
+        return result
+
+    def cached(self, name, la):
+        # a stage whose output came from the stage cache
+        rows, cols = self.shape(la)
+        self.add({'stage': name, 'cached': True, 'rows_before': None,
+            'cols_before': None, 'wall_time': None, 'cpu_time': None,
+            'peak_memory': None, 'rows_after': rows, 'cols_after': cols})
+
+    def add(self, record):
+        self.records.append(record)
+        # the record is also on the log record for structured handlers
+        if record['cached']:
+            logger.info('%s stage from cache, %s rows', record['stage'],
+                    record['rows_after'], extra={'stage_report': record})
+        else:
+            logger.info('%s stage: %.3fs wall, %.3fs cpu, %s bytes peak, '
+                    '%s rows', record['stage'], record['wall_time'],
+                    record['cpu_time'], record['peak_memory'],
+                    record['rows_after'], extra={'stage_report': record})
+
+    def to_json(self):
+        return json.dumps({'stages': self.records}, indent=2)
@@ -0,0 +1,98 @@
+import io
+import logging
+import numpy
+import matplotlib
+matplotlib.use('Agg')  # no display or browser needed, draws in process
+from matplotlib.figure import Figure
+from matplotlib.patches import Rectangle
+
+# font lookups are logged at debug level, too noisy for the app log
+logging.getLogger('matplotlib').setLevel(logging.WARNING)
+
+# bokeh sizes are in screen pixels, figures are drawn at this dpi so the
+# images in the zip keep the size of the page charts
+DPI = 100
+
+
+def save(fig, formats):
+    # one figure can be saved in several formats, e.g. svg and png, the
+    # image bytes are returned so they can go straight into the zip
+    images = []
+    for fmt in formats:
+        out = io.BytesIO()
+        fig.savefig(out, format=fmt, bbox_inches='tight')
+        images.append(out.getvalue())
+    return images
+
+
+def bar_chart(formats, gr_data, data, x, y, title, y_label, lipids, groups,
+        colors, std=None, y_axis_type=None):
+    # same layout as the bokeh class charts, one bar per lipid class and group
+    fig = Figure(figsize=(1500 / DPI, 600 / DPI), dpi=DPI)
+    ax = fig.add_subplot(1, 1, 1)
+    if y_axis_type == 'log':
+        bottom = 0.0000000001
+        ax.set_yscale('log')
+    else:
+        bottom = 0
+    for i, (group, d) in enumerate(gr_data.items()):
+        heights = numpy.maximum(numpy.asarray(d[y], dtype=float) - bottom, 0)
+        ax.bar(d[x], heights, width=0.5, bottom=bottom, label=group,
+                color=colors[i])
+    if std:
+        # whiskers at the top of each bar
+        center = numpy.asarray(data[y], dtype=float)
+        spread = numpy.asarray(data[std], dtype=float)
+        lower = numpy.maximum(center - spread, bottom)
+        ax.errorbar(data[x], center, yerr=[center - lower, spread], fmt='none',
+                ecolor='black', elinewidth=1, capsize=3)
+    # group under each bar, lipid class under each set of bars
+    ax.set_xticks(data[x])
+    ax.set_xticklabels([group for lipid in lipids for group in groups],
+            rotation='vertical')
+    per_lipid = len(groups)
+    for i, lipid in enumerate(lipids):
+        center = numpy.mean(data[x][i * per_lipid:(i + 1) * per_lipid])
+        ax.annotate(lipid, xy=(center, 0), xycoords=('data', 'axes fraction'),
+                xytext=(0, -40), textcoords='offset points', ha='center',
+                va='top', rotation=45)
+    ax.set_ylim(bottom=bottom)
+    ax.set_title(title)
+    ax.set_ylabel(y_label)
+    ax.legend(loc='upper right')
+    return save(fig, formats)
+
+
+def volcano_plot(formats, title, data, colors, ratio_highlight,
+        pvalue_highlight):
+    # data is class name -> {'log2': [...], 'p': [...]} as in the bokeh plot
+    fig = Figure(figsize=(1000 / DPI, 800 / DPI), dpi=DPI)
+    ax = fig.add_subplot(1, 1, 1)
+    for i, (class_name, source) in enumerate(data.items()):
+        log2 = numpy.asarray(source['log2'], dtype=float)
+        p = numpy.asarray(source['p'], dtype=float)
+        finite = numpy.isfinite(log2) & numpy.isfinite(p)
+        # bokeh size is the diameter in pixels, matplotlib wants an area
+        ax.scatter(log2[finite], p[finite], s=10 ** 2 * 0.5, color=colors[i],
+                alpha=0.5, label=class_name, linewidths=0)
+    # highlight up and down regulated regions after the points so the
+    # boxes cover the whole visible area
+    x_min, x_max = ax.get_xlim()
+    y_min, y_max = ax.get_ylim()
+    if y_max > pvalue_highlight:
+        height = y_max - pvalue_highlight
+        if x_min < -ratio_highlight:
+            ax.add_patch(Rectangle((x_min, pvalue_highlight),
+                -ratio_highlight - x_min, height, color='red', alpha=0.1,
+                linewidth=0))
+        if x_max > ratio_highlight:
+            ax.add_patch(Rectangle((ratio_highlight, pvalue_highlight),
+                x_max - ratio_highlight, height, color='green', alpha=0.1,
+                linewidth=0))
+    ax.set_xlim(x_min, x_max)
+    ax.set_ylim(y_min, y_max)
+    ax.set_title(title)
+    ax.set_xlabel('log2(ratio)')
+    ax.set_ylabel('-log10(p value)')
+    ax.legend(loc='upper left', bbox_to_anchor=(1.0, 1.0))
+    return save(fig, formats)
@@ -0,0 +1,167 @@
+import argparse
+import os
+import numpy
+
+# lipid classes with the number of fatty acid chains and a retention time
+# offset, longer chains elute later and double bonds earlier
+CLASSES = (
+    ('PC', 2, 0.0), ('PE', 2, 0.5), ('PS', 2, -0.5), ('PI', 2, -1.0),
+    ('PG', 2, -0.8), ('PA', 2, -0.6), ('LPC', 1, -6.0), ('LPE', 1, -5.5),
+    ('SM', 2, -0.3), ('Cer', 2, 1.5), ('DG', 2, 3.0), ('TG', 3, 8.0),
+    ('CL', 4, 4.0), ('ChE', 1, 9.0), ('FA', 1, -8.0),
+)
+ADDUCTS = {
+    'neg': ('-H', '+HCOO', '+CH3COO', '-2H'),
+    'pos': ('+H', '+NH4', '+Na', '+H-H2O'),
+}
+GROUPS = ('c', 's1', 's2', 's3')
+# data lines generated and written at a time
+CHUNK_ROWS = 10000
+# ions of one lipid are within ION_SPREAD of its retention time, isomers
+# are 1 to ISOMER_SPREAD away
+ION_SPREAD = 0.3
+ISOMER_SPREAD = 2.5
+
+
+def header_lines(groups, replicates, polarity):
+    # the # block LipidSearch puts above the cols, one raw file per sample
+    lines = []
+    for group in groups:
+        for rep in range(1, replicates + 1):
+            lines.append('#[%s-%d]:%s_%s_%02d.raw' % (group, rep, polarity,
+                group, rep))
+    lines.extend(['#normalize base:', '#control group:' + groups[0],
+        '#toprank filter:true', '#mScoreThreshold:5.0',
+        '#cScoreThreshold:2.0', ''])
+    return lines
+
+
+def sample_cols(groups, replicates):
+    return ['%s-%d' % (group, rep) for group in groups for rep in
+            range(1, replicates + 1)]
+
+
+def columns(groups, replicates):
+    samples = sample_cols(groups, replicates)
+    cols = ['Rej.', 'LipidIon', 'LipidGroup', 'Class', 'FattyAcid', 'FA1',
+            'FA2', 'FA3', 'FA4', 'CalcMz', 'IonFormula']
+    cols.extend('ARatio[%s/%s]' % (group, groups[0]) for group in groups[1:])
+    for prefix in ('GroupArea', 'GroupHeight', 'GroupTopPos', 'GroupPQ',
+            'GroupS/N'):
+        cols.extend('%s[%s]' % (prefix, group) for group in groups)
+    for prefix in ('Area', 'Height', 'TopPos'):
+        cols.extend('%s[%s]' % (prefix, sample) for sample in samples)
+    return cols
+
+
+def lipid_text(rng, polarity):
+    # names and formula cols of the ions of one lipid, one per adduct, and
+    # the lipid's retention time
+    cls, chains, offset = CLASSES[rng.randint(len(CLASSES))]
+    carbons = rng.randint(12, 25, chains)
+    bonds = numpy.minimum(rng.poisson(1.5, chains), 6)
+    acids = '/'.join('%d:%d' % (c, b) for c, b in zip(carbons, bonds))
+    fas = ['(%d:%d)' % (c, b) for c, b in zip(carbons, bonds)]
+    fas = (fas + [''] * 4)[:4]
+    mz = 180.0 + 14.01565 * carbons.sum() - 2.01565 * bonds.sum() + 40 * chains
+    formula = 'C%d H%d O%d P1' % (carbons.sum() + 8, 2 * carbons.sum() -
+            2 * bonds.sum() + 16, 2 * chains + 6)
+    texts = []
+    adducts = ADDUCTS[polarity]
+    for i in rng.permutation(len(adducts))[:rng.randint(1, 4)]:
+        adduct = adducts[i]
+        texts.append(['%s(%s)%s' % (cls, acids, adduct),
+            '%s(%d:%d)%s' % (cls, carbons.sum(), bonds.sum(), adduct), cls,
+            '(%s)' % acids] + fas + ['%.8f' % mz, formula])
+    rt = 14.0 + offset + 0.45 * (carbons.sum() / chains - 18) - 0.6 * bonds.sum()
+    return texts, rt
+
+
+def chunk(rng, rows, groups, replicates, polarity, reject_rate):
+    # text and values of rows lipid ions, the ions of a lipid have retention
+    # times close together and some lipids have an isomer farther away, so
+    # ions cluster per lipid charge as in real exports
+    texts = []
+    rts = []
+    while len(texts) < rows:
+        ions, rt = lipid_text(rng, polarity)
+        for text in ions:
+            texts.append(text)
+            rts.append(rt + rng.uniform(-ION_SPREAD, ION_SPREAD))
+        if rng.random_sample() < 0.1:
+            texts.append(ions[0])
+            rts.append(rt + rng.choice((-1, 1)) * rng.uniform(1, ISOMER_SPREAD))
+    texts = texts[:rows]
+    rt = numpy.clip(numpy.array(rts[:rows]), 0.5, 35.0)
+    n_groups = len(groups)
+    # abundance of each lipid, fold change of each group, replicate noise
+    # and a blank well below the samples
+    base = rng.lognormal(13, 2, rows)
+    fold = rng.lognormal(0, 0.6, (rows, n_groups))
+    fold[:, 0] = 0.02
+    areas = (base[:, None, None] * fold[:, :, None] *
+            rng.lognormal(0, 0.25, (rows, n_groups, replicates)))
+    areas[rng.random_sample(areas.shape) < 0.05] = 0
+    areas = areas.reshape(rows, n_groups * replicates)
+    heights = areas / rng.uniform(8, 30, areas.shape)
+    top_pos = rt[:, None] + rng.normal(0, 0.05, areas.shape)
+    group_area = areas.reshape(rows, n_groups, replicates).mean(axis=2)
+    group_height = heights.reshape(rows, n_groups, replicates).mean(axis=2)
+    group_top_pos = numpy.repeat(rt[:, None], n_groups, axis=1)
+    group_pq = rng.beta(5, 2, (rows, n_groups))
+    group_sn = rng.lognormal(5, 1.5, (rows, n_groups))
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        ratios = group_area[:, 1:] / group_area[:, :1]
+    values = numpy.hstack([ratios, group_area, group_height, group_top_pos,
+        group_pq, group_sn, areas, heights, top_pos])
+    rejects = rng.random_sample(rows) < reject_rate
+    return texts, rejects, values
+
+
+def generate(path, features, groups=GROUPS, replicates=3, polarity='neg',
+        seed=0, reject_rate=0.05):
+    # write a LipidSearch export with features data lines to path
+    rng = numpy.random.RandomState(seed)
+    cols = columns(groups, replicates)
+    with open(path, 'w') as f:
+        f.write('\n'.join(header_lines(groups, replicates, polarity)) + '\n')
+        f.write('\t'.join(cols) + '\n')
+        written = 0
+        while written < features:
+            rows = min(CHUNK_ROWS, features - written)
+            texts, rejects, values = chunk(rng, rows, groups, replicates,
+                    polarity, reject_rate)
+            # one format string for all numbers of a row
+            fmt = '\t'.join(['%.6g'] * values.shape[1])
+            lines = []
+            for text, reject, row in zip(texts, rejects, values.tolist()):
+                lines.append('%d\t%s\t%s\n' % (reject, '\t'.join(text),
+                    fmt % tuple(row)))
+            f.writelines(lines)
+            written += rows
+    return path
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+            description='Write synthetic LipidSearch exports')
+    parser.add_argument('out_dir')
+    parser.add_argument('--features', type=int, nargs='+', default=[1000])
+    parser.add_argument('--groups', default=','.join(GROUPS),
+            help='comma separated, the first is the blank')
+    parser.add_argument('--replicates', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(args)
+    if not os.path.exists(args.out_dir):
+        os.makedirs(args.out_dir)
+    for features in args.features:
+        for i, polarity in enumerate(('neg', 'pos')):
+            path = os.path.join(args.out_dir, '%s_%d.txt' % (polarity,
+                features))
+            generate(path, features, args.groups.split(','),
+                    args.replicates, polarity, args.seed + i)
+            print(path)
+
+
+if __name__ == '__main__':
+    main()
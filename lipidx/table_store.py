@@ -0,0 +1,111 @@
+import hashlib
+import io
+import os
+import numpy
+from lipidx.lipid_table import LipidTable
+from lipidx.result_cache import ResultCache
+
+
+class HashWriter(io.BufferedIOBase):
+    # passes bytes on to out and adds them to a hash, e.g. a csv written
+    # into a zip entry, out is not closed with it
+    def __init__(self, out, digest):
+        self.out = out
+        self.digest = digest
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.digest.update(b)
+        return self.out.write(b)
+
+
+class TableStore:
+    # results tables the app wrote as csv kept in binary form, keyed on a
+    # hash of the csv, so a results file that is uploaded again, e.g. to
+    # the volcano or pca page, is loaded without parsing it, other files
+    # are not found and are parsed as before, entries are kept in a
+    # ResultCache so the least recently used are removed above max_bytes
+    NUMERIC_FILE = 'numeric.npy'
+    TEXT_FILE = 'text.txt'
+    # dirs under root of the entries and of an empty file named for the
+    # size of each csv kept, uploads of other sizes, e.g. LipidSearch
+    # exports, can't be in the store and are not hashed
+    ENTRIES_DIR = 'entries'
+    SIZES_DIR = 'sizes'
+    # text cells that would not read back the same from the csv
+    UNSAFE = (',', '"', '\n', '\r', LipidTable.TEXT_SEP)
+
+    def __init__(self, root, max_bytes):
+        self.cache = ResultCache(os.path.join(root, self.ENTRIES_DIR),
+                max_bytes)
+        self.sizes = os.path.join(root, self.SIZES_DIR)
+
+    @staticmethod
+    def new_digest():
+        # the hash of ResultCache.file_digest, keys of csvs written by the app
+        return hashlib.sha256()
+
+    def size_marker(self, size):
+        return os.path.join(self.sizes, str(size))
+
+    def put(self, key, table, order, size):
+        # table as it was written to the csv with key and size in bytes, rows
+        # in order and numbers rounded the same way, so loading it gives the
+        # table parsing the csv would, tables that wouldn't are not kept
+        if 'name' not in table.cols or any(c != c.lower() for c in
+                table.cols):
+            return None
+        cells = table.text[order].ravel().tolist()
+        if any(not isinstance(cell, str) or any(s in cell for s in
+                self.UNSAFE) for cell in cells):
+            return None
+        numeric = table.numeric[order]
+        for col, decimals in table.round_to.items():
+            if col in table.num_index:
+                j = table.num_index[col]
+                numeric[:, j] = [round(val, decimals) for val in
+                        numeric[:, j].tolist()]
+        out = io.BytesIO()
+        numpy.save(out, numeric)
+        context = {'cols': table.cols, 'rows': len(order)}
+        entry = self.cache.put(key, context, data={
+            self.NUMERIC_FILE: out.getvalue(),
+            self.TEXT_FILE: LipidTable.TEXT_SEP.join(cells).encode()})
+        if entry is not None:
+            if not os.path.exists(self.sizes):
+                os.makedirs(self.sizes, exist_ok=True)
+            open(self.size_marker(size), 'w').close()
+        return entry
+
+    def get(self, path):
+        # the table of a csv at path, None if it is not in the store, only
+        # files the size of a csv that was kept are hashed
+        try:
+            if not os.path.exists(self.size_marker(os.path.getsize(path))):
+                return None
+        except OSError:
+            return None
+        context, entry = self.cache.get(
+                ResultCache.file_digest(path).hexdigest())
+        if context is None:
+            return None
+        try:
+            # numbers are read from the file as they are used, changes are
+            # only made to this process's copy
+            numeric = numpy.load(os.path.join(entry, self.NUMERIC_FILE),
+                    mmap_mode='c')
+            with open(os.path.join(entry, self.TEXT_FILE), 'rb') as f:
+                joined = f.read().decode()
+        except (OSError, ValueError):
+            return None
+        cols = context['cols']
+        rows = context['rows']
+        width = len([c for c in cols if not LipidTable.is_numeric_col(c)])
+        text = numpy.empty((rows, width), dtype=object)
+        if text.size:
+            text.ravel()[:] = joined.split(LipidTable.TEXT_SEP)
+        table = LipidTable([''] * rows, cols, text, numeric)
+        table.names = table.column('name').copy()
+        return table
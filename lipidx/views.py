@@ -1,15 +1,20 @@
 from flask import (request, current_app, render_template,
-    send_from_directory, Blueprint)
+    send_from_directory, send_file, Blueprint, redirect, url_for, abort,
+    jsonify)
 from lipidx.lipid_analysis import LipidAnalysis
 from lipidx.pca_analysis import PCAAnalysis
+from lipidx.result_cache import ResultCache
+from lipidx.lipid_pipeline import LipidPipeline
+from lipidx.jobs import JobQueue
+from lipidx.workspace import Workspaces
+from lipidx.stage_report import StageReport
+from lipidx.settings import AnalysisSettings
 from lipidx import forms
+import os
+import mimetypes
+import shutil
+import tempfile
 import time
-from bokeh.plotting import figure
-from bokeh.models import Legend
-from bokeh.embed import components
-from bokeh.palettes import d3
-from sklearn.decomposition import PCA
-from sklearn.preprocessing import StandardScaler
 import numpy
 import logging
 
@@ -17,6 +22,10 @@ logger = logging.getLogger()
 
 lipidx_bp = Blueprint('lipidx', __name__, static_folder='./static')
 
+# config that changes the page or zip, part of the cache key
+CACHE_CONFIG = ('LAZY_RESULTS', 'ZIP_COMPRESS_LEVEL', 'VOLCANO_BACKEND',
+        'VOLCANO_MAX_POINTS')
+
 
 @lipidx_bp.route('/lipid_analysis/', methods=['GET', 'POST'])
 def lipid_analysis():
@@ -29,7 +38,12 @@ def lipid_analysis():
     logger.debug("Checking form")
     if form.validate_on_submit():
         logger.debug("Made it to the form validation")
-        root_path = current_app.config['UPLOAD_FOLDER']
+        # uploads and results are kept in a dir of their own so concurrent
+        # runs don't replace each other's files
+        runs = workspaces()
+        run_id = runs.create()
+        context['run_id'] = run_id
+        root_path = runs.path(run_id)
         file1 = request.files[form.file1.name]
         file1.save(root_path + 'file1.txt')
 
@@ -41,54 +55,41 @@ def lipid_analysis():
             file2.save(root_path + 'file2.txt')
             file2_path = root_path + 'file2.txt'
             files.append(file2_path)
-        start = time.time()
-        la = LipidAnalysis(files, debug)
-        curr = time.time()
-        print('LA' + str(start - curr))
-        la.remove_rejects()
-        last = curr
-        curr = time.time()
-        print('Remove' + str(last - curr))
-        la.group_ions(form.data['group_ions_within'])
-        last = curr
-        curr = time.time()
-        print('Group' + str(last - curr))
-        la.filter_rows(form.data['retention_time_filter'],
-                form.data['group_pq_filter'],
-                form.data['group_sn_filter'],
-                form.data['group_area_filter'],
-                form.data['group_height_filter']
-        )
-        last = curr
-        curr = time.time()
-        print('Filter' + str(last - curr))
-        la.subtract_blank(form.data['blank'], form.data['mult_factor'])
-        last = curr
-        curr = time.time()
-        print('blank' + str(last - curr))
-        la.remove_columns(form.data['remove_cols'])
-        last = curr
-        curr = time.time()
-        print('remove cols' + str(last - curr))
-        la.normalize(form.data)
-        last = curr
-        curr = time.time()
-        print('normal' + str(last - curr))
-        if form.data['class_stats']:
-            subclass_stats, class_stats = la.calc_class_stats()
-            last = curr
-            curr = time.time()
-            print('stats' + str(last - curr))
-            context['class_script'], context['class_div'] = la.class_plot()
-            last = curr
-            curr = time.time()
-            print('bars' + str(last - curr))
-        context['volcano_script'], context['volcano_div'] = la.volcano_plot(form.data)
-        last = curr
-        curr = time.time()
-        print('volcano' + str(last - curr))
-        zip_path = la.write_results()
+        cache = result_cache()
+        input_key = cache.file_key(files)
+        key = None
+        if cache.max_bytes:
+            key = cache.key(input_key, cache_params(form, debug))
+            cached, entry = cache.get(key)
+            if cached is not None:
+                # same files and params as an earlier run
+                zip_path = restore_results(entry, root_path)
+                if zip_path is not None:
+                    context.update(cached)
+                    logger.debug("Used cached Lipid Analysis results")
+                    return render_template('lipid_analysis.html', form=form,
+                            zip_path=zip_path, **context)
+        if current_app.config.get('BACKGROUND_JOBS'):
+            job_queue().submit(run_id, root_path, files, form_params(form,
+                debug), stage_cache(), analysis_settings(root_path),
+                current_app.config.get('TRACE_STAGE_MEMORY', False),
+                cache if key else None, key)
+            return redirect(url_for('lipidx.job', job_id=run_id,
+                **context['params']))
+        # stages reuse the output of earlier runs with the same files and
+        # params, only stages after a changed param are run again
+        report = stage_report(debug)
+        pipeline = LipidPipeline(stage_cache(), files, input_key,
+                dict(form.data, debug=debug), root_path, report,
+                analysis_settings(root_path))
+        la = pipeline.run()
+        context.update(pipeline.context)
+        zip_path = write_results(la, context, report)
         logger.debug("Wrote Lipid Analysis output to file")
+        if debug:
+            context['stage_report'] = report.records
+        if key:
+            cache.put_results(key, la, context)
     return render_template('lipid_analysis.html', form=form, zip_path=zip_path, **context)
 
 
@@ -98,19 +99,29 @@ def volcano():
     zip_path = None
     context = {}
     if form.validate_on_submit():
-        root_path = current_app.config['UPLOAD_FOLDER']
+        runs = workspaces()
+        run_id = runs.create()
+        context['run_id'] = run_id
+        root_path = runs.path(run_id)
         file1 = request.files[form.file1.name]
         file1.save(root_path + 'file1.txt')
         file1_path = root_path + 'file1.txt'
 
-        la = LipidAnalysis([file1_path])
-        context['volcano_script'], context['volcano_div'] = la.volcano_plot(form.data)
-        zip_path = la.write_results()
+        report = stage_report(False)
+        la = report.run('read', lambda la: LipidAnalysis([file1_path],
+            root_path=root_path, settings=analysis_settings(root_path)))
+        context['volcano_script'], context['volcano_div'] = report.run(
+                'volcano', lambda la: la.volcano_plot(form.data), la)
+        zip_path = write_results(la, context, report)
     return render_template('volcano.html', form=form, zip_path=zip_path, **context)
 
 
 @lipidx_bp.route('/pca_test/', methods=['GET', 'POST'])
 def pca_test():
+    # bokeh and sklearn are only imported by the views that draw plots
+    from bokeh.embed import components
+    from bokeh.plotting import figure
+    from sklearn.decomposition import PCA
     context = {}
     form = forms.PCAForm()
     zip_path = None
@@ -145,19 +156,174 @@ def pca():
     zip_path = None
     context = {}
     if form.validate_on_submit():
-        root_path = current_app.config['UPLOAD_FOLDER']
+        runs = workspaces()
+        root_path = runs.path(runs.create())
         file1 = request.files[form.file1.name]
         file1.save(root_path + 'pca_file.txt')
         path = root_path + 'pca_file.txt'
-        pca = PCAAnalysis(path)
+        pca = PCAAnalysis(path, analysis_settings(root_path).table_store())
         plot = pca.pca()
+        from bokeh.embed import components
         context = {}
         context['pca_script'], context['pca_div'] = components(plot)
     return render_template('pca.html', form=form, zip_path=zip_path, **context)
 
 
-@lipidx_bp.route('/file/<filename>')
-def file(filename):
-    file_dir = current_app.config['UPLOAD_FOLDER']
+def write_results(la, context, report):
+    # the report of the stages so far goes in the zip, the export stage is
+    # only logged and shown on the page
+    la.zip_data[report.FILE] = report.to_json().encode()
+    return report.run('export', lambda la: export_results(la, context), la)
+
+
+def export_results(la, context):
+    if current_app.config.get('LAZY_RESULTS'):
+        # the zip is built by the file view when it is downloaded
+        la.save_snapshot()
+        return la.zip_path
+    if os.path.exists(la.snapshot_path):
+        # results of a lazy run must not be used for the files of this one
+        os.remove(la.snapshot_path)
+    zip_path = la.write_results()
+    context['chart_errors'] = la.chart_errors
+    return zip_path
+
+
+def stage_report(debug):
+    return StageReport(debug or current_app.config.get('TRACE_STAGE_MEMORY',
+        False))
+
+
+def analysis_settings(root_path):
+    # the analysis only knows the app through these
+    return AnalysisSettings.from_config(current_app.config, root_path)
+
+
+def result_cache():
+    return ResultCache(current_app.config['UPLOAD_FOLDER'] + 'cache/',
+            current_app.config.get('RESULT_CACHE_SIZE', 0))
+
+
+def stage_cache():
+    return ResultCache(current_app.config['UPLOAD_FOLDER'] + 'stages/',
+            current_app.config.get('STAGE_CACHE_SIZE', 0))
+
+
+def workspaces():
+    return Workspaces(current_app.config['UPLOAD_FOLDER'] + 'runs/',
+            current_app.config.get('RUN_MAX_AGE', 0),
+            current_app.config.get('RUN_MAX_SIZE', 0))
+
+
+def job_queue():
+    state_dir = current_app.config['STATE_FOLDER']
+    if not os.path.exists(state_dir):
+        os.makedirs(state_dir, exist_ok=True)
+    jobs = JobQueue(os.path.join(state_dir, 'jobs.db'),
+            current_app.config.get('JOB_PROCESSES', 2))
+    if current_app.config.get('RUN_MAX_AGE'):
+        # the run dirs of older jobs are gone
+        jobs.remove_old(time.time() - current_app.config['RUN_MAX_AGE'])
+    jobs.fail_stale(current_app.config.get('JOB_TIMEOUT', 0))
+    return jobs
+
+
+def form_params(form, debug):
+    # everything besides the uploaded files that changes the analysis
+    params = {k: v for k, v in form.data.items() if k not in
+            (form.file1.name, form.file2.name, 'csrf_token', 'submit')}
+    params['debug'] = debug
+    return params
+
+
+def cache_params(form, debug):
+    # form params and the config that changes the page or zip
+    params = form_params(form, debug)
+    for name in CACHE_CONFIG:
+        params[name] = current_app.config.get(name)
+    return params
+
+
+def restore_results(entry, root_path):
+    # files of the cached run are copied to the dir of this one, None if
+    # the entry was evicted while it was copied
+    copied = []
+    try:
+        for name in os.listdir(entry):
+            if name != ResultCache.CONTEXT_FILE:
+                shutil.copyfile(os.path.join(entry, name), root_path + name)
+                copied.append(root_path + name)
+    except OSError:
+        logger.exception("Could not restore cached Lipid Analysis results")
+        for path in copied:
+            os.remove(path)
+        return None
+    return root_path + LipidAnalysis.ZIP_FILE
+
+
+@lipidx_bp.route('/job/<job_id>/')
+def job(job_id):
+    job = job_queue().get(job_id)
+    if job is None or not workspaces().exists(job_id):
+        abort(404)
+    if job['status'] != JobQueue.DONE:
+        # the page reloads itself until the job is done or failed
+        return render_template('job.html', job=job,
+                params=request.args.to_dict())
+    # the finished job's page, with its form values filled in
+    form = forms.LipidAnalysisForm(data=job['params'])
+    context = dict(job['context'], params=request.args.to_dict())
+    return render_template('lipid_analysis.html', form=form, zip_path=True,
+            run_id=job_id, **context)
+
+
+@lipidx_bp.route('/job/<job_id>/status')
+def job_status(job_id):
+    job = job_queue().get(job_id)
+    if job is None:
+        abort(404)
+    return jsonify({k: job[k] for k in ('id', 'status', 'error', 'created',
+        'started', 'finished')})
+
+
+@lipidx_bp.route('/file/<run_id>/<filename>')
+def run_file(run_id, filename):
+    # results of one run, only ids of existing runs are used in paths
+    runs = workspaces()
+    if not runs.exists(run_id):
+        abort(404)
+    file_dir = runs.path(run_id)
+    snapshot_path = file_dir + LipidAnalysis.SNAPSHOT_FILE
+    if (not os.path.exists(os.path.join(file_dir, filename)) and
+            os.path.exists(snapshot_path)):
+        # lazy mode, build the file from the saved results
+        la = LipidAnalysis.load_snapshot(snapshot_path)
+        data = la.write_artifact(filename)
+        if data is not None:
+            # kept in the run dir so later downloads are served from it, a
+            # temp file is renamed so a half written one is never served
+            fd, tmp = tempfile.mkstemp(dir=file_dir, prefix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    shutil.copyfileobj(data, f)
+                os.replace(tmp, os.path.join(file_dir, filename))
+            except OSError:
+                # e.g. a full disk, this download is served from memory
+                logger.exception("Could not keep %s of run %s", filename,
+                        run_id)
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                data.seek(0)
+                return send_file(data,
+                        mimetype=mimetypes.guess_type(filename)[0])
+            data.close()
     return send_from_directory(file_dir, filename)
 
+
+@lipidx_bp.route('/file/<filename>')
+def file(filename):
+    # files shared by all runs, e.g. the example input files, nothing else
+    # of the files dir is served, the files of a run are served by run_file
+    if filename not in current_app.config['SHARED_FILES']:
+        abort(404)
+    return send_from_directory(current_app.config['FILE_FOLDER'], filename)
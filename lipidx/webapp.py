@@ -0,0 +1,18 @@
+from flask import Flask
+from flask_bootstrap import Bootstrap
+from lipidx.views import lipidx_bp
+from lipidx import config
+import logging
+import sys, os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'lipid_analysis.log'))
+logging.basicConfig(level=logging.DEBUG)
+# named for the package, as when the app was made in its __init__
+app = Flask('lipidx')
+app.register_blueprint(lipidx_bp, url_prefix='/lipidx', static_folder='static')
+app.config.from_object(config)
+bootstrap = Bootstrap()
+bootstrap.init_app(app)
+
+import lipidx.views
@@ -0,0 +1,67 @@
+import os
+import re
+import shutil
+import time
+import uuid
+
+
+class Workspaces:
+    # each run gets its own dir for the uploaded files and its results so
+    # concurrent runs never share a path, dirs older than max_age seconds are
+    # removed and then the oldest until they fit in max_bytes
+    RUN_ID_RE = re.compile('[0-9a-f]{32}')
+
+    def __init__(self, root, max_age, max_bytes):
+        self.root = root
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+
+    def create(self):
+        # a new run id, old runs are cleaned up first
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        self.cleanup()
+        run_id = uuid.uuid4().hex
+        os.makedirs(self.path(run_id))
+        return run_id
+
+    def path(self, run_id):
+        # dir of a run, None for anything but a run id so it is safe to use
+        # ids from urls
+        if not self.RUN_ID_RE.fullmatch(run_id):
+            return None
+        return os.path.join(self.root, run_id) + '/'
+
+    def exists(self, run_id):
+        path = self.path(run_id)
+        return path is not None and os.path.isdir(path)
+
+    def run_size(self, path):
+        return sum(os.path.getsize(os.path.join(path, name)) for name in
+                os.listdir(path))
+
+    def cleanup(self):
+        runs = []
+        expired = time.time() - self.max_age
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if not self.RUN_ID_RE.fullmatch(name) or not os.path.isdir(path):
+                continue
+            try:
+                mtime = os.path.getmtime(path)
+                if self.max_age and mtime < expired:
+                    shutil.rmtree(path, ignore_errors=True)
+                    continue
+                runs.append((mtime, self.run_size(path), path))
+            except OSError:
+                # removed by another worker
+                continue
+        if not self.max_bytes:
+            return
+        total = sum(size for _, size, _ in runs)
+        # oldest first
+        for _, size, path in sorted(runs):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
@@ -1,10 +1,41 @@
 import unittest
+from unittest import mock
 import os
 import csv
+import io
 import json
+import math
+import pickle
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+import numpy
+from scipy.stats import ttest_ind
 from lipidx.lipid_analysis import LipidAnalysis
+from lipidx.lipid_table import LipidTable
+from lipidx.lipid_reader import LipidSearchReader
+from lipidx import static_charts
+from lipidx import synthetic_data
+from lipidx import batch
+from lipidx.result_cache import ResultCache
+from lipidx.lipid_pipeline import LipidPipeline
+from lipidx.workspace import Workspaces
+from lipidx.jobs import JobQueue
+from lipidx.stage_report import StageReport
+from lipidx.settings import AnalysisSettings
+from lipidx.pca_analysis import PCAAnalysis
 from lipidx.forms import LipidAnalysisForm as form
 from lipidx import app
+from lipidx import views
+
+def exit_worker(formats):
+    # a chart worker that dies, e.g. killed for running out of memory
+    os._exit(1)
+
 
 class LididxTests(unittest.TestCase):
 
@@ -13,9 +44,18 @@ class LididxTests(unittest.TestCase):
         self.app = app.test_client()
         self.sample_data_dir = (os.path.abspath( os.path.dirname( __file__ ) ) +
         '/sample_data/')
+        # results, caches and stores of a test run go to a tmp dir, not the
+        # files dir of the package
+        self.upload_folder = app.config['UPLOAD_FOLDER']
+        self.state_folder = app.config['STATE_FOLDER']
+        app.config['UPLOAD_FOLDER'] = tempfile.mkdtemp() + '/'
+        app.config['STATE_FOLDER'] = tempfile.mkdtemp() + '/'
 
     def tearDown(self):
-        pass
+        shutil.rmtree(app.config['UPLOAD_FOLDER'])
+        shutil.rmtree(app.config['STATE_FOLDER'])
+        app.config['UPLOAD_FOLDER'] = self.upload_folder
+        app.config['STATE_FOLDER'] = self.state_folder
 
     def test_lipid_analysis_init_cnt(self):
         res = False
@@ -34,6 +74,72 @@ class LididxTests(unittest.TestCase):
             res, msg = self.diff_dicts(expected, la.rows)
         self.assertTrue(res, msg)
 
+    def test_lipid_table_numeric_block(self):
+        res = False
+        with app.app_context():
+            la = LipidAnalysis([self.sample_data_dir + 'neg_short.txt', self.sample_data_dir + 'pos_short.txt'])
+            areas = la.table.prefix_values('area')
+            # area cols are parsed once into a float matrix
+            res = (areas.dtype == numpy.float64 and areas.shape == (64, 19))
+        assert res
+
+    def test_lipid_table_rows_round_trip(self):
+        with app.app_context():
+            la = LipidAnalysis([self.sample_data_dir + 'neg_short.txt'])
+            rows = la.rows
+            table = LipidTable.from_rows(rows)
+        self.assertEqual(rows, table.to_rows())
+
+    def test_reader_chunks(self):
+        # a small chunk size must give the same table as a single chunk
+        path = self.sample_data_dir + 'neg_short.txt'
+        whole = LipidSearchReader(path).read()
+        chunked = LipidSearchReader(path, chunk_rows=7).read()
+        self.assertEqual(whole.cols[:3], ['name', 'ret_time', 'rej.'])
+        self.assertEqual(whole.to_rows(), chunked.to_rows())
+
+    def test_read_files_in_workers(self):
+        neg = self.sample_data_dir + 'neg_short.txt'
+        pos = self.sample_data_dir + 'pos_short.txt'
+        with app.app_context():
+            la = LipidAnalysis([neg, pos])
+        # cols are the ones in both headers, in the order of the first file
+        pos_cols = set(LipidSearchReader(pos).header())
+        cols = [c for c in LipidSearchReader(neg).header() if c in pos_cols]
+        self.assertEqual(la.table.cols, cols)
+        # tables come back from the workers unchanged
+        table = LipidAnalysis.read_file(neg, cols)
+        copy = pickle.loads(pickle.dumps(table))
+        self.assertEqual(table.to_rows(), copy.to_rows())
+
+    def test_read_error_stops_workers(self):
+        import multiprocessing
+        def read_file(path, cols=None, round_to=None):
+            raise ValueError('unreadable ' + path)
+        paths = [self.sample_data_dir + 'neg_short.txt',
+                self.sample_data_dir + 'pos_short.txt']
+        # e.g. the job pool of another test
+        before = set(multiprocessing.active_children())
+        with mock.patch.object(LipidAnalysis, 'read_file',
+                staticmethod(read_file)):
+            with app.app_context():
+                with self.assertRaises(ValueError):
+                    LipidAnalysis(paths)
+        # the read pool is not left running
+        self.assertEqual(set(multiprocessing.active_children()) - before,
+                set())
+
+    def test_schema_after_subtract_blank(self):
+        with app.app_context():
+            la = LipidAnalysis([self.sample_data_dir + 'neg_short.txt'])
+            la.subtract_blank('c', form.MULT_FACTOR_DEFAULT)
+            schema = la.table.schema
+            area_cols = [c for c in la.table.cols if c.startswith('area[')]
+            # blank cols are dropped from the schema along with the table
+            self.assertEqual(schema.cols('area'), area_cols)
+            self.assertEqual(list(la.groups), ['s1', 's2', 's3', 's4'])
+            self.assertEqual(la.table.group_values('s1').shape[1], 3)
+
     def test_group_ions_diff(self):
         res = False
         with app.app_context():
@@ -59,6 +165,18 @@ class LididxTests(unittest.TestCase):
             res, msg = self.diff_dicts(expected, la.rows)
         self.assertTrue(res, msg)
 
+    def test_filter_rows_thresholds(self):
+        with app.app_context():
+            la = LipidAnalysis([self.sample_data_dir + 'neg_short.txt'])
+            la.filter_rows(form.RET_TIME_DEFAULT, form.GROUP_PQ_DEFAULT,
+                    form.GROUP_SN_DEFAULT, 1000000, 0)
+            self.assertTrue(len(la.table) > 0)
+            # every kept row passes every threshold
+            self.assertTrue((la.table.column('ret_time') > form.RET_TIME_DEFAULT).all())
+            self.assertTrue((la.row_max('grouppq') > form.GROUP_PQ_DEFAULT).all())
+            self.assertTrue((la.row_max('groups/n') > form.GROUP_SN_DEFAULT).all())
+            self.assertTrue((la.row_max('grouparea') > 1000000).all())
+
     def test_subtract_blank(self):
         res = False
         with app.app_context():
@@ -69,6 +187,18 @@ class LididxTests(unittest.TestCase):
             res, msg = self.diff_dicts(expected, la.rows)
         self.assertTrue(res, msg)
 
+    def test_subtract_blank_rounds_on_output(self):
+        with app.app_context():
+            la = LipidAnalysis([self.sample_data_dir + 'neg_short.txt'])
+            la.subtract_blank('c', form.MULT_FACTOR_DEFAULT)
+            name = la.table.names[0]
+            avg_blank = la.table.column('avg_blank')[0]
+            # the table keeps full precision, rows are rounded
+            self.assertEqual(la.rows[name]['avg_blank'],
+                    round(avg_blank, la.settings.round_to))
+            self.assertTrue((la.table.prefix_values('area') >= 0).all())
+            self.assertNotIn('area[c-1]', la.table)
+
     def test_remove_columns(self):
         res = False
         with app.app_context():
@@ -91,6 +221,35 @@ class LididxTests(unittest.TestCase):
             res, msg = self.diff_dicts(expected, la.rows)
         self.assertTrue(res, msg)
 
+    def test_calc_ratio_matches_row_ttest(self):
+        with app.app_context():
+            la = LipidAnalysis([self.sample_data_dir + 'neg_short.txt'])
+            ratio_name = la.calc_ratio('s1', 's2')
+            p_values = la.table.column('p_value[' + ratio_name + ']')
+            s1 = la.table.group_values('s1')
+            s2 = la.table.group_values('s2')
+            for i in range(len(la.table)):
+                if s1[i].sum() + s2[i].sum() == 0.0:
+                    expected = 1.0
+                else:
+                    t, expected = ttest_ind(s1[i], s2[i], equal_var=False)
+                self.assertTrue(numpy.isclose(p_values[i], expected,
+                    rtol=1e-12, equal_nan=True))
+
+    def test_normalize_values(self):
+        with app.app_context():
+            la = LipidAnalysis([self.sample_data_dir + 'neg_short.txt'])
+            before = la.table.group_values('s1').copy()
+            c_before = la.table.group_values('c').copy()
+            la.normalize({'normalize': 'values', 'normal_c': '',
+                'normal_s1': '1, 2, 4, 8'})
+            # replicate n is divided by the nth value of the field
+            expected = before / numpy.array([2.0, 4.0, 8.0])
+            self.assertTrue(numpy.allclose(la.table.group_values('s1'), expected))
+            self.assertTrue(numpy.array_equal(la.table.group_values('c'), c_before))
+            self.assertTrue(numpy.allclose(la.table.column('grouparea[s1]'),
+                expected.mean(axis=1)))
+
     def test_class_stats(self):
         res = False
         with app.app_context():
@@ -98,7 +257,7 @@ class LididxTests(unittest.TestCase):
             la = self.get_inst_from_step('remove_expected.csv')
             expected = self.csv_to_row_dict(self.sample_data_dir +
             'class_stats_expected.csv', 'class')
-            la.calc_class_stats({'class_stats':'y'})
+            la.calc_class_stats()
             res, msg = self.diff_dicts(expected, la.class_dict)
         self.assertTrue(res, msg)
 
@@ -109,16 +268,550 @@ class LididxTests(unittest.TestCase):
             la = self.get_inst_from_step('remove_expected.csv')
             expected = self.csv_to_row_dict(self.sample_data_dir +
             'subclass_stats_expected.csv', 'subclass')
-            la.calc_class_stats({'class_stats':'y'})
+            la.calc_class_stats()
             res, msg = self.diff_dicts(expected, la.subclass_dict)
         self.assertTrue(res, msg)
 
+    def test_class_stats_match_row_means(self):
+        with app.app_context():
+            la = LipidAnalysis([self.sample_data_dir + 'neg_short.txt'])
+            la.calc_class_stats()
+            # rebuild one class by hand from the rows that map to it
+            name = next(iter(la.class_stats))
+            keys = [k for k, v in la.class_keys.items() if v['class'] == name]
+            in_class = numpy.isin(la.table.column('class').astype(str), keys)
+            for group in la.groups:
+                areas = la.table.group_values(group)[in_class]
+                means = areas.mean(axis=1)
+                stats = la.class_stats[name][group]
+                self.assertEqual(stats['cnt'], int((areas.max(axis=1) > 0).sum()))
+                self.assertTrue(math.isclose(stats['sum'], means.sum()))
+                self.assertTrue(math.isclose(stats['avg'], means.mean()))
+                self.assertTrue(math.isclose(stats['std'], means.std()))
+                self.assertEqual(la.class_dict[name][group + ' cnt'], stats['cnt'])
+
+    def test_static_chart_files(self):
+        with app.app_context():
+            la = LipidAnalysis([self.sample_data_dir + 'neg_short.txt'])
+            la.root_path = tempfile.mkdtemp() + '/'
+            la.calc_class_stats()
+            la.class_plot()
+            la.volcano_plot({'group1': 's1', 'group2': 's2', 'group3': '',
+                'group4': '', 'group5': '', 'group6': '',
+                'ratio_highlight': 2, 'pvalue_highlight': 0.05})
+            la.export_charts()
+        # charts are drawn without a browser, check they are real images
+        self.assertIn('volcano_s1-over-s2.svg', la.chart_images)
+        for name, image in la.chart_images.items():
+            head = image[:8]
+            if name.endswith('.png'):
+                self.assertEqual(head, b'\x89PNG\r\n\x1a\n')
+            elif name.endswith('.svg'):
+                self.assertTrue(head.startswith(b'<?xml'))
+        shutil.rmtree(la.root_path)
+
+    def test_export_charts_keeps_going(self):
+        with app.app_context():
+            la = LipidAnalysis([self.sample_data_dir + 'neg_short.txt'])
+            la.root_path = tempfile.mkdtemp() + '/'
+            la.chart_processes = 2
+            la.calc_class_stats()
+            la.class_plot()
+            # a chart that fails to draw in a worker
+            la.add_chart(['broken.png'], static_charts.bar_chart, (None,) * 9)
+            errors = la.export_charts()
+        self.assertEqual(list(errors), ['broken.png'])
+        self.assertNotIn('broken.png', la.chart_images)
+        charts = [f for f in la.chart_images if f.startswith('class_chart_')]
+        self.assertEqual(len(charts), 5)
+        shutil.rmtree(la.root_path)
+
+    def test_export_charts_worker_dies(self):
+        with app.app_context():
+            la = LipidAnalysis([self.sample_data_dir + 'neg_short.txt'])
+            la.chart_processes = 2
+            la.chart_timeout = 2
+            la.calc_class_stats()
+            la.class_plot()
+            la.add_chart(['killed.png'], exit_worker, ())
+            errors = la.export_charts()
+        # the lost chart times out, the others are still drawn
+        self.assertEqual(list(errors), ['killed.png'])
+        self.assertIn('TimeoutError', errors['killed.png'])
+        charts = [f for f in la.chart_images if f.startswith('class_chart_')]
+        self.assertEqual(len(charts), 5)
+
+    def test_lazy_results_from_snapshot(self):
+        runs = Workspaces(app.config['UPLOAD_FOLDER'] + 'runs/', 0, 0)
+        run_id = runs.create()
+        run_url = '/lipidx/file/' + run_id + '/'
+        with app.app_context():
+            la = LipidAnalysis([self.sample_data_dir + 'neg_short.txt'],
+                    root_path=runs.path(run_id))
+            la.calc_class_stats()
+            la.class_plot()
+            la.volcano_plot({'group1': 's1', 'group2': 's2', 'group3': '',
+                'group4': '', 'group5': '', 'group6': '',
+                'ratio_highlight': 2, 'pvalue_highlight': 0.05})
+            la.save_snapshot()
+        # nothing is drawn until a file is asked for
+        self.assertFalse(os.path.exists(la.zip_path))
+        res = self.app.get(run_url + 'volcano_s1-over-s2.png')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.data[:4], b'\x89PNG')
+        self.assertFalse(os.path.exists(la.zip_path))
+        # the image is kept for the next download
+        self.assertTrue(os.path.exists(la.root_path + 'volcano_s1-over-s2.png'))
+        res.close()
+        res = self.app.get(run_url + 'lipid_results.zip')
+        self.assertEqual(res.status_code, 200)
+        # the zip is finalized and kept in the run dir, no temp files are left
+        self.assertTrue(os.path.exists(la.zip_path))
+        self.assertFalse([f for f in os.listdir(la.root_path)
+            if f.startswith('.tmp')])
+        z = zipfile.ZipFile(io.BytesIO(res.data))
+        self.assertIsNone(z.testzip())
+        names = z.namelist()
+        self.assertIn('lipid_analysis.csv', names)
+        self.assertIn('class_chart_area.png', names)
+        self.assertIn('volcano_s1-over-s2.svg', names)
+        self.assertEqual(self.app.get(run_url + 'other.png').status_code, 404)
+
+    def test_write_results_zip(self):
+        with app.app_context():
+            la = LipidAnalysis([self.sample_data_dir + 'neg_short.txt'])
+            expected = la.table.to_rows()
+            out = io.BytesIO()
+            la.zip_level = 9
+            la.write_results(out)
+        z = zipfile.ZipFile(out)
+        self.assertIsNone(z.testzip())
+        info = z.getinfo('lipid_analysis.csv')
+        self.assertEqual(info.compress_type, zipfile.ZIP_DEFLATED)
+        self.assertLess(info.compress_size, info.file_size)
+        with z.open('lipid_analysis.csv') as f:
+            rows = list(csv.DictReader(io.TextIOWrapper(f, newline='')))
+        self.assertEqual(len(rows), len(expected))
+        self.assertEqual(set(r['name'] for r in rows), set(expected))
+
+    def test_class_stats_in_zip(self):
+        with app.app_context():
+            la = LipidAnalysis([self.sample_data_dir + 'neg_short.txt'])
+            la.calc_class_stats()
+            out = io.BytesIO()
+            la.write_results(out)
+        # the stats go straight into the zip, no file is left in the run dir
+        self.assertFalse([f for f in os.listdir(app.config['UPLOAD_FOLDER'])
+            if f.endswith('.csv')])
+        z = zipfile.ZipFile(out)
+        for cat, stats in (('class', la.class_dict),
+                ('subclass', la.subclass_dict)):
+            with z.open(cat + '_stats.csv') as f:
+                rows = list(csv.DictReader(io.TextIOWrapper(f, newline='')))
+            self.assertEqual([r[cat] for r in rows], list(stats))
+
+    def test_thin_volcano_points(self):
+        with app.app_context():
+            la = LipidAnalysis([self.sample_data_dir + 'neg_short.txt'])
+        rng = numpy.random.RandomState(1)
+        log2 = rng.normal(0, 1, 20000)
+        p = numpy.abs(rng.normal(0, 1, 20000))
+        significant = (p >= 1.3) & (numpy.abs(log2) >= 1.0)
+        # off by default
+        self.assertTrue(la.thin_volcano_points(log2, p, 1.0, 1.3).all())
+        la.volcano_max_points = 3000
+        keep = la.thin_volcano_points(log2, p, 1.0, 1.3)
+        # every point in the highlight boxes stays on the page
+        self.assertTrue(keep[significant].all())
+        self.assertLessEqual(keep.sum(), 3000)
+        self.assertGreater(keep.sum(), significant.sum())
+
+    def test_result_cache_hit(self):
+        app.config['WTF_CSRF_ENABLED'] = False
+        try:
+            pages = []
+            for i in range(2):
+                with open(self.sample_data_dir + 'neg_short.txt', 'rb') as f:
+                    res = self.app.post('/lipidx/lipid_analysis/', data={
+                        'file1': (f, 'neg_short.txt'), 'group1': 's1',
+                        'group2': 's2'}, content_type='multipart/form-data')
+                self.assertEqual(res.status_code, 200)
+                pages.append(res.data)
+            self.assertIn(b'Download Lipid Analysis File', pages[0])
+            # each run has its own files
+            zip_urls = [re.search(rb'/lipidx/file/\w+/lipid_results.zip',
+                page).group().decode() for page in pages]
+            self.assertNotEqual(zip_urls[0], zip_urls[1])
+            # bokeh ids are random, the same page means it came from the cache
+            self.assertEqual(pages[0].replace(zip_urls[0].encode(), b''),
+                    pages[1].replace(zip_urls[1].encode(), b''))
+            entries = os.listdir(app.config['UPLOAD_FOLDER'] + 'cache/')
+            self.assertEqual(len(entries), 1)
+            res = self.app.get(zip_urls[1])
+            names = zipfile.ZipFile(io.BytesIO(res.data)).namelist()
+            res.close()
+            self.assertIn('lipid_analysis.csv', names)
+        finally:
+            app.config['WTF_CSRF_ENABLED'] = True
+
+    def test_restore_evicted_results(self):
+        entry = tempfile.mkdtemp() + '/'
+        root = app.config['UPLOAD_FOLDER']
+        with open(entry + LipidAnalysis.ZIP_FILE, 'wb') as f:
+            f.write(b'zip')
+        # a file that can't be copied, like one removed by an eviction
+        os.mkdir(entry + 'evicted')
+        self.assertIsNone(views.restore_results(entry, root))
+        # nothing half copied is left for the run that falls back
+        self.assertEqual(os.listdir(root), [])
+        shutil.rmtree(entry)
+        self.assertIsNone(views.restore_results(entry, root))
+        # an entry evicted between reading its context and marking it used
+        cache = ResultCache(root + 'cache/', 1024)
+        entry = cache.put('key', {'a': 1})
+        utime = os.utime
+        def evict(path, *args):
+            shutil.rmtree(path)
+            utime(path, *args)
+        with mock.patch('os.utime', evict):
+            self.assertEqual(cache.get('key'), (None, None))
+
+    def test_background_job(self):
+        app.config['WTF_CSRF_ENABLED'] = False
+        app.config['BACKGROUND_JOBS'] = True
+        try:
+            with open(self.sample_data_dir + 'neg_short.txt', 'rb') as f:
+                res = self.app.post('/lipidx/lipid_analysis/', data={
+                    'file1': (f, 'neg_short.txt'), 'group1': 's1',
+                    'group2': 's2'}, content_type='multipart/form-data')
+            self.assertEqual(res.status_code, 302)
+            job_url = res.headers['Location']
+            for i in range(120):
+                status = self.app.get(job_url + 'status').get_json()
+                if status['status'] in ('done', 'failed'):
+                    break
+                time.sleep(0.5)
+            self.assertEqual(status['status'], 'done', status['error'])
+            page = self.app.get(job_url)
+            self.assertIn(b'Download Lipid Analysis File', page.data)
+            job_id = job_url.split('/')[-2]
+            res = self.app.get('/lipidx/file/' + job_id + '/' +
+                    LipidAnalysis.ZIP_FILE)
+            names = zipfile.ZipFile(io.BytesIO(res.data)).namelist()
+            res.close()
+            self.assertIn('lipid_analysis.csv', names)
+            self.assertEqual(self.app.get('/lipidx/job/nope/').status_code, 404)
+            # the finished job is in the result cache, the same files sent
+            # again are not a new job
+            self.assertEqual(len(os.listdir(app.config['UPLOAD_FOLDER'] +
+                'cache/')), 1)
+            with open(self.sample_data_dir + 'neg_short.txt', 'rb') as f:
+                res = self.app.post('/lipidx/lipid_analysis/', data={
+                    'file1': (f, 'neg_short.txt'), 'group1': 's1',
+                    'group2': 's2'}, content_type='multipart/form-data')
+            self.assertEqual(res.status_code, 200)
+            self.assertIn(b'Download Lipid Analysis File', res.data)
+            # the job state is not in a dir files are served from
+            self.assertTrue(os.path.exists(app.config['STATE_FOLDER'] +
+                'jobs.db'))
+            self.assertEqual(self.app.get('/lipidx/file/jobs.db').status_code,
+                    404)
+        finally:
+            app.config['WTF_CSRF_ENABLED'] = True
+            app.config['BACKGROUND_JOBS'] = False
+
+    def test_shared_files(self):
+        res = self.app.get('/lipidx/file/pca_template.csv')
+        self.assertEqual(res.status_code, 200)
+        res.close()
+        # only the listed files are served, not what runs leave behind
+        with open(app.config['UPLOAD_FOLDER'] + 'class_stats.csv', 'w') as f:
+            f.write('class\n')
+        for name in ('class_stats.csv', 'README.md', 'jobs.db'):
+            self.assertEqual(self.app.get('/lipidx/file/' + name).status_code,
+                    404)
+
+    def test_stale_jobs_fail(self):
+        jobs = JobQueue(app.config['STATE_FOLDER'] + 'jobs.db', 1)
+        # a job that can't be sent to the pool is failed, not left queued
+        jobs.submit('unpicklable', app.config['UPLOAD_FOLDER'], [],
+                {'f': lambda: None}, None, None)
+        for i in range(60):
+            if jobs.get('unpicklable')['status'] == JobQueue.FAILED:
+                break
+            time.sleep(0.5)
+        self.assertEqual(jobs.get('unpicklable')['status'], JobQueue.FAILED)
+        # jobs of a server process that is gone, and ones past the timeout
+        gone = subprocess.Popen([sys.executable, '-c', ''])
+        gone.wait()
+        with jobs.connect() as db:
+            for job_id, created, owner in (('gone', time.time(), gone.pid),
+                    ('old', time.time() - 100, os.getpid()),
+                    ('new', time.time(), os.getpid())):
+                db.execute('INSERT INTO jobs (id, status, created, owner) '
+                        'VALUES (?, ?, ?, ?)', (job_id, JobQueue.QUEUED,
+                        created, owner))
+        jobs.fail_stale(50)
+        self.assertEqual(jobs.get('gone')['status'], JobQueue.FAILED)
+        self.assertEqual(jobs.get('old')['error'], 'timed out')
+        self.assertEqual(jobs.get('new')['status'], JobQueue.QUEUED)
+        # a failed job is not run when the pool gets to it
+        jobs.run('old', None, [], {}, None, None)
+        self.assertEqual(jobs.get('old')['status'], JobQueue.FAILED)
+
+    def test_workspace_cleanup(self):
+        root = tempfile.mkdtemp() + '/'
+        runs = Workspaces(root, 3600, 2500)
+        ids = []
+        for i in range(3):
+            run_id = runs.create()
+            with open(runs.path(run_id) + 'file1.txt', 'wb') as f:
+                f.write(b'x' * 1000)
+            os.utime(runs.path(run_id), (i, i))
+            ids.append(run_id)
+        self.assertIsNone(runs.path('../cache'))
+        # past max_age all three are removed
+        runs.create()
+        self.assertFalse(any(runs.exists(run_id) for run_id in ids))
+        runs.max_age = 0
+        for run_id in ids:
+            os.makedirs(runs.path(run_id))
+            with open(runs.path(run_id) + 'file1.txt', 'wb') as f:
+                f.write(b'x' * 1000)
+        os.utime(runs.path(ids[0]), (0, 0))
+        # above max_bytes the oldest is removed
+        runs.cleanup()
+        self.assertEqual([runs.exists(run_id) for run_id in ids],
+                [False, True, True])
+        shutil.rmtree(root)
+
+    def test_result_cache_evicts_oldest(self):
+        root = tempfile.mkdtemp() + '/'
+        src = root + 'result.zip'
+        with open(src, 'wb') as f:
+            f.write(b'x' * 1000)
+        cache = ResultCache(root + 'cache/', 2500)
+        for key in ('a', 'b'):
+            cache.put(key, {'div': key}, {'result.zip': src})
+        # using a makes b the least recently used
+        os.utime(cache.entry_dir('b'), (0, 0))
+        self.assertEqual(cache.get('a')[0], {'div': 'a'})
+        cache.put('c', {'div': 'c'}, {'result.zip': src})
+        self.assertEqual(cache.get('b'), (None, None))
+        self.assertEqual(cache.get('c')[0], {'div': 'c'})
+        shutil.rmtree(root)
+
+    def test_pipeline_reruns_changed_stages(self):
+        root = tempfile.mkdtemp() + '/'
+        paths = [self.sample_data_dir + 'neg_short.txt']
+        params = {'debug': False, 'group_ions_within': 0.9,
+                'retention_time_filter': 3, 'group_pq_filter': 0.8,
+                'group_sn_filter': 100, 'group_area_filter': 0,
+                'group_height_filter': 0, 'blank': 'c', 'mult_factor': 3,
+                'remove_cols': ', '.join(form.COLS_TO_REMOVE),
+                'normalize': 'intensity', 'class_stats': True,
+                'group1': 's1', 'group2': 's2', 'group3': '', 'group4': '',
+                'group5': '', 'group6': '', 'ratio_highlight': 2,
+                'pvalue_highlight': 0.05}
+        with app.app_context():
+            cache = ResultCache(root, 100 * 1024 * 1024)
+            key = cache.file_key(paths)
+            first = LipidPipeline(cache, paths, key, params).run()
+            # only the volcano stage uses pvalue_highlight
+            pipeline = LipidPipeline(cache, paths, key, dict(params,
+                pvalue_highlight=0.01))
+            ran = []
+            for name, fields, save in pipeline.STAGES:
+                stage = getattr(pipeline, 'stage_' + name)
+                setattr(pipeline, 'stage_' + name, lambda la, name=name,
+                        stage=stage: ran.append(name) or stage(la))
+            second = pipeline.run()
+        self.assertEqual(ran, ['volcano'])
+        self.assertIn('class_div', pipeline.context)
+        self.assertEqual(first.table.to_rows(), second.table.to_rows())
+        shutil.rmtree(root)
+
+    def test_stage_report(self):
+        app.config['WTF_CSRF_ENABLED'] = False
+        try:
+            with open(self.sample_data_dir + 'neg_short.txt', 'rb') as f:
+                res = self.app.post('/lipidx/lipid_analysis/?debug', data={
+                    'file1': (f, 'neg_short.txt'), 'group1': 's1',
+                    'group2': 's2'}, content_type='multipart/form-data')
+            self.assertIn(b'class="stage_report"', res.data)
+            zip_url = re.search(rb'/lipidx/file/\w+/lipid_results.zip',
+                res.data).group().decode()
+            res = self.app.get(zip_url)
+            report = json.loads(zipfile.ZipFile(io.BytesIO(res.data)).read(
+                StageReport.FILE))
+            res.close()
+            stages = report['stages']
+            self.assertEqual([s['stage'] for s in stages],
+                    [name for name, fields, save in LipidPipeline.STAGES])
+            self.assertEqual(stages[0]['rows_before'], None)
+            # each stage starts with the table the one before left
+            for before, after in zip(stages, stages[1:]):
+                self.assertEqual(before['rows_after'], after['rows_before'])
+            # rejects and filtered rows are counted in their own stages
+            self.assertEqual(stages[1]['stage'], 'remove_rejects')
+            self.assertTrue(stages[1]['rows_after'] < stages[1]['rows_before'])
+            self.assertTrue(stages[3]['rows_after'] < stages[3]['rows_before'])
+            # debug runs trace memory
+            self.assertTrue(all(s['peak_memory'] > 0 for s in stages))
+            self.assertTrue(all(s['wall_time'] >= 0 for s in stages))
+        finally:
+            app.config['WTF_CSRF_ENABLED'] = True
+
+    def test_synthetic_data(self):
+        root = tempfile.mkdtemp() + '/'
+        path = synthetic_data.generate(root + 'neg.txt', 500,
+                ('c', 's1', 's2'), 2, seed=1)
+        with app.app_context():
+            la = LipidAnalysis([path], root_path=root)
+            self.assertEqual(len(la.table), 500)
+            self.assertEqual(la.groups, {'c': ['1', '2'], 's1': ['1', '2'],
+                's2': ['1', '2']})
+            la.remove_rejects()
+            rows = len(la.table)
+            # ions of one lipid elute together and are grouped
+            la.group_ions(form.ION_GROUP_WITHIN_DEFAULT)
+            self.assertTrue(0 < len(la.table) < rows)
+        # the same seed gives the same file
+        synthetic_data.generate(root + 'again.txt', 500, ('c', 's1', 's2'),
+                2, seed=1)
+        with open(path) as a, open(root + 'again.txt') as b:
+            self.assertEqual(a.read(), b.read())
+        shutil.rmtree(root)
+
+    def test_batch_runs(self):
+        root = tempfile.mkdtemp() + '/'
+        with open(root + 'manifest.csv', 'w') as f:
+            f.write('name,file1,file2,blank,group1,group2,class_stats\n')
+            f.write('short,%sneg_short.txt,%spos_short.txt,c,s1,s2,false\n' %
+                    (self.sample_data_dir, self.sample_data_dir))
+            f.write('missing,missing.txt,,,,,\n')
+        runs = batch.read_manifest(root + 'manifest.csv',
+                LipidPipeline.default_params())
+        self.assertEqual(runs[0]['params']['class_stats'], False)
+        self.assertEqual(runs[1]['files'], [root + 'missing.txt'])
+        # a failed run is reported and the others still run
+        self.assertEqual(batch.main([root + 'manifest.csv', root + 'out',
+            '--processes', '2']), 1)
+        with open(root + 'out/' + batch.SUMMARY_FILE) as f:
+            summary = json.load(f)
+        self.assertEqual([r['status'] for r in summary['runs']],
+                ['ok', 'failed'])
+        names = zipfile.ZipFile(root + 'out/short/' +
+                LipidAnalysis.ZIP_FILE).namelist()
+        self.assertIn('volcano_s1-over-s2.png', names)
+        self.assertNotIn('class_stats.csv', names)
+        shutil.rmtree(root)
+
+    def test_analysis_without_app(self):
+        # the analysis modules import without the flask app or its config
+        env = dict(os.environ)
+        env.pop('LIPIDX_ADMIN_EMAILS', None)
+        code = ('import sys, lipidx.lipid_pipeline, lipidx.jobs; '
+                'print(sorted(m for m in ("lipidx.webapp", "lipidx.views", '
+                '"flask_bootstrap") if m in sys.modules))')
+        out = subprocess.run([sys.executable, '-c', code], env=env,
+                cwd=os.path.dirname(self.sample_data_dir[:-1]) + '/..',
+                stdout=subprocess.PIPE, check=True).stdout
+        self.assertEqual(out.strip(), b'[]')
+        # results go to the settings' dir outside of an app context
+        root = tempfile.mkdtemp() + '/'
+        la = LipidAnalysis([self.sample_data_dir + 'neg_short.txt'],
+                settings=AnalysisSettings(root, zip_level=9))
+        self.assertEqual(la.root_path, root)
+        self.assertEqual(la.zip_level, 9)
+        self.assertTrue(os.path.exists(la.write_results()))
+        shutil.rmtree(root)
+
+    def test_table_store(self):
+        root = tempfile.mkdtemp() + '/'
+        settings = AnalysisSettings(root, table_store_root=root + 'tables/',
+                table_store_size=1024 * 1024 * 1024)
+        la = LipidAnalysis([self.sample_data_dir + 'neg_short.txt',
+            self.sample_data_dir + 'pos_short.txt'], settings=settings)
+        la.subtract_blank('c', form.MULT_FACTOR_DEFAULT)
+        la.write_results()
+        zipfile.ZipFile(la.zip_path).extract(la.lipid_results_file, root)
+        path = root + la.lipid_results_file
+        store = settings.table_store()
+        # files the app didn't write are parsed, without hashing them unless
+        # a kept csv had the same size
+        self.assertEqual(os.listdir(store.sizes),
+                [str(os.path.getsize(path))])
+        self.assertIsNone(store.get(self.sample_data_dir + 'neg_short.txt'))
+        with open(root + 'same_size.csv', 'wb') as f:
+            f.write(b'x' * os.path.getsize(path))
+        self.assertIsNone(store.get(root + 'same_size.csv'))
+        # the results csv loads as the table parsing it gives
+        parsed = LipidAnalysis([path], settings=AnalysisSettings(root)).table
+        stored = LipidAnalysis([path], settings=settings).table
+        # the numbers are a view of the mapped file, not a copy
+        self.assertFalse(stored.numeric.flags.owndata)
+        self.assertEqual(stored.cols, parsed.cols)
+        self.assertEqual(stored.to_rows(), parsed.to_rows())
+        pca = PCAAnalysis(path, store)
+        self.assertIsNone(pca.rows)
+        cols = pca.get_sample_cols()
+        self.assertEqual(cols, PCAAnalysis(path).get_sample_cols())
+        self.assertTrue(numpy.array_equal(pca.get_sample_data(cols),
+            parsed.values(cols)))
+        shutil.rmtree(root)
+
+    def test_analysis_without_forms(self):
+        # worker processes run the analysis without the flask form stack
+        code = ('import sys; from lipidx.lipid_analysis import LipidAnalysis; '
+                'la = LipidAnalysis([sys.argv[1]]); '
+                'la.volcano_plot({"group1": "s1", "group2": "s2", '
+                '"group3": "", "group4": "", "group5": "", "group6": "", '
+                '"ratio_highlight": 0, "pvalue_highlight": 0}); '
+                'print(sorted(m for m in ("flask_wtf", "wtforms", '
+                '"lipidx.forms") if m in sys.modules))')
+        out = subprocess.run([sys.executable, '-c', code,
+                self.sample_data_dir + 'neg_short.txt'],
+                cwd=os.path.dirname(self.sample_data_dir[:-1]) + '/..',
+                stdout=subprocess.PIPE, check=True).stdout.decode()
+        self.assertEqual(out.split('\n')[0], '[]')
+
+    def test_import_budget(self):
+        # the app and the analysis load without the plotting and stats
+        # libraries, those are imported when a page or chart needs them
+        code = ('import sys, time; start = time.perf_counter(); '
+                'import lipidx.webapp; print(time.perf_counter() - start); '
+                'print(sorted(m for m in ("bokeh", "scipy", "sklearn", '
+                '"matplotlib", "multiprocessing", '
+                '"concurrent.futures.process") if m in sys.modules))')
+        out = subprocess.run([sys.executable, '-c', code],
+                cwd=os.path.dirname(self.sample_data_dir[:-1]) + '/..',
+                stdout=subprocess.PIPE, check=True).stdout.decode()
+        seconds, heavy = out.split('\n')[:2]
+        self.assertEqual(heavy, '[]')
+        # with them it took over 2s
+        self.assertLess(float(seconds), 1.5)
+
+    def test_app_import_error(self):
+        # a missing setting is reported, not hidden behind the name of app
+        env = {k: v for k, v in os.environ.items() if k !=
+                'LIPIDX_ADMIN_EMAILS'}
+        res = subprocess.run([sys.executable, '-c', 'from lipidx import app'],
+                cwd=os.path.dirname(self.sample_data_dir[:-1]) + '/..',
+                env=env, stderr=subprocess.PIPE)
+        err = res.stderr.decode()
+        self.assertNotEqual(res.returncode, 0)
+        self.assertIn("has no attribute 'split'", err)
+        self.assertNotIn('cannot import name', err)
+
     # helper function get csv file into same format as rows for diff
     def csv_to_row_dict(self, csv_file, key_on = 'name'):
         row_dict = {}
         with open(csv_file, mode='r') as f:
             rows = csv.DictReader(f)
-            row_dict = {r[key_on]: r for r in rows}
+            # cols are lowercased when files are read, do the same here
+            row_dict = {r[key_on]: {k.lower(): v for k, v in r.items()} for r
+                    in rows}
         return row_dict
 
     def diff_keys(self, exp_keys, test_keys):
@@ -152,6 +845,9 @@ class LididxTests(unittest.TestCase):
                     elif col in test[key]:
                         val_str = str(val)
                         test_str = str(test[key][col])
+                        # numbers written in another notation, e.g. 5.81E+07
+                        if self.same_number(val_str, test_str):
+                            continue
                         # trying to get floating pt rounded numbers to match is
                         # a pain, there is a bunch of logic here to try and
                         # ignore insignificant digit differences
@@ -176,6 +872,12 @@ class LididxTests(unittest.TestCase):
             msg = 'row errors: ' + json.dumps(errors)
         return same, msg
 
+    def same_number(self, val_str, test_str):
+        try:
+            return math.isclose(float(val_str), float(test_str), rel_tol=1e-9)
+        except ValueError:
+            return False
+
     def get_inst_from_step(self, prev_step_file):
         # pass empty path and then fill rows with prev step results
         la = LipidAnalysis([])